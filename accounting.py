@@ -0,0 +1,392 @@
+# accounting.py
+# Token and cost accounting per restaurant, thread and graph node.
+#
+# Every LLM response (through UsageCallbackHandler, added to each graph turn) and
+# every external call (Airtable, Sheets, embeddings) is appended as one row to a
+# local SQLite table. Rows are queued and written by a background thread, so the
+# turn never waits on the accounting DB. Rollups group the rows by restaurant,
+# day and node. Per-restaurant daily budgets are checked against the day's
+# spend in the DB, shared by every worker process (re-read every
+# SPEND_REFRESH_SECONDS): a restaurant over budget gets a cheaper model and
+# skips extract_data. Summaries keep running, on the cheaper model.
+#
+# Rollup from the command line:  python accounting.py rollup restaurant,day
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import ensure_config
+
+USAGE_DB_PATH = "data/crm/usage.db"
+BUDGETS_PATH = "data/crm/budgets.json"
+
+# Daily budget in USD for restaurants not listed in budgets.json (0 = no limit)
+DEFAULT_DAILY_BUDGET_USD = float(os.getenv("AUTOFLUJO_DAILY_BUDGET_USD", "0"))
+# Model used for restaurants over budget
+BUDGET_MODEL = os.getenv("AUTOFLUJO_BUDGET_MODEL", "llama-3.1-8b-instant")
+# How often a process re-reads a restaurant's spend written by the others
+SPEND_REFRESH_SECONDS = 15
+
+# USD per million tokens: (input, output)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+}
+# USD per call of external APIs (flat plans are 0 but calls are still counted)
+CALL_PRICES = {"airtable": 0.0, "sheets": 0.0, "sendgrid": 0.0}
+
+GROUP_COLUMNS = ("restaurant", "thread_id", "day", "node", "kind", "model")
+
+
+def cost_usd(model, input_tokens, output_tokens):
+    for name, (input_price, output_price) in MODEL_PRICES.items():
+        # Versioned names like "gpt-4o-mini-2024-07-18" use the base price
+        if model == name or model.startswith(name + "-"):
+            return (input_tokens * input_price + output_tokens * output_price) / 1e6
+    return 0.0
+
+
+def current_context():
+    """(restaurant, thread_id, node) of the graph run calling this ("" outside one)."""
+    config = ensure_config()
+    configurable = config.get("configurable", {})
+    metadata = config.get("metadata", {})
+    return (
+        str(configurable.get("restaurant", "")),
+        str(configurable.get("thread_id", "")),
+        str(metadata.get("langgraph_node", "")),
+    )
+
+
+# ----------------------------------------------------------
+# Store
+# ----------------------------------------------------------
+class UsageStore:
+    """
+    Append-only usage table with a background writer. Daily spend per
+    restaurant (for budget checks) is read from the table, so it covers every
+    process writing to it.
+    """
+
+    def __init__(self, db_path=USAGE_DB_PATH, budgets_path=BUDGETS_PATH):
+        self.db_path = db_path
+        self.budgets = {}
+        if os.path.exists(budgets_path):
+            with open(budgets_path, encoding="utf-8") as f:
+                # {"restaurant@email.com": {"daily_usd": 2.0}, ...}
+                self.budgets = json.load(f)
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS usage_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                day TEXT NOT NULL,
+                restaurant TEXT NOT NULL,
+                thread_id TEXT NOT NULL,
+                node TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                calls INTEGER NOT NULL,
+                cost_usd REAL NOT NULL
+            )""")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_usage_restaurant_day "
+            "ON usage_events (restaurant, day)"
+        )
+        conn.commit()
+
+        conn.close()
+
+        # restaurant -> [day, read_at, spend in the DB, spend recorded here since]
+        self._lock = threading.Lock()
+        self._spend = {}
+
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name="usage-writer", daemon=True).start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def record(
+        self,
+        kind,
+        model="",
+        input_tokens=0,
+        output_tokens=0,
+        calls=1,
+        cost=None,
+        restaurant=None,
+        thread_id=None,
+        node=None,
+    ):
+        """
+        Queues one usage row. restaurant, thread_id and node default to those of
+        the graph run calling this.
+        """
+        context = current_context()
+        restaurant = context[0] if restaurant is None else restaurant
+        thread_id = context[1] if thread_id is None else thread_id
+        node = context[2] if node is None else node
+        if cost is None:
+            cost = cost_usd(
+                model, input_tokens, output_tokens
+            ) + calls * CALL_PRICES.get(kind, 0.0)
+
+        day = self._today()
+        with self._lock:
+            entry = self._spend.get(restaurant)
+            if entry is not None and entry[0] == day:
+                # Counted until the next read finds the row in the DB
+                entry[3] += cost
+        self._queue.put(
+            (
+                time.time(),
+                day,
+                restaurant,
+                thread_id,
+                node,
+                kind,
+                model,
+                input_tokens,
+                output_tokens,
+                calls,
+                cost,
+            )
+        )
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            rows = [self._queue.get()]
+            while not self._queue.empty():
+                rows.append(self._queue.get_nowait())
+            try:
+                conn.executemany(
+                    "INSERT INTO usage_events (ts, day, restaurant, thread_id, node, "
+                    "kind, model, input_tokens, output_tokens, calls, cost_usd) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Error writing usage rows: {e}")
+            time.sleep(0.5)  # Batch the rows of concurrent turns
+
+    # ------------------------------------------------------
+    # Budgets
+    # ------------------------------------------------------
+    def daily_budget(self, restaurant):
+        return float(
+            self.budgets.get(restaurant, {}).get("daily_usd", DEFAULT_DAILY_BUDGET_USD)
+        )
+
+    def spent_today(self, restaurant):
+        """Today's spend of the restaurant across every process."""
+        day = self._today()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._spend.get(restaurant)
+            if (
+                entry is not None
+                and entry[0] == day
+                and now - entry[1] < SPEND_REFRESH_SECONDS
+            ):
+                return entry[2] + entry[3]
+
+        conn = self._connect()
+        try:
+            spent = conn.execute(
+                "SELECT COALESCE(SUM(cost_usd), 0) FROM usage_events "
+                "WHERE restaurant = ? AND day = ?",
+                (restaurant, day),
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        with self._lock:
+            self._spend[restaurant] = [day, now, spent, 0.0]
+        return spent
+
+    def over_budget(self, restaurant):
+        budget = self.daily_budget(restaurant)
+        return budget > 0 and self.spent_today(restaurant) >= budget
+
+    # ------------------------------------------------------
+    # Rollups
+    # ------------------------------------------------------
+    def rollup(self, by=("restaurant", "day", "node"), since=None, restaurant=None):
+        """
+        Totals grouped by any of GROUP_COLUMNS.
+
+        Args:
+            by: Columns to group by.
+            since: Only days >= this 'YYYY-MM-DD'.
+            restaurant: Only this restaurant.
+        """
+        columns = [column for column in by if column in GROUP_COLUMNS]
+        query = (
+            f"SELECT {', '.join(columns + [''])}"
+            "SUM(input_tokens), SUM(output_tokens), SUM(calls), SUM(cost_usd) "
+            "FROM usage_events WHERE 1 = 1"
+        )
+        params = []
+        if since:
+            query += " AND day >= ?"
+            params.append(since)
+        if restaurant is not None:
+            query += " AND restaurant = ?"
+            params.append(restaurant)
+        if columns:
+            query += f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}"
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        keys = columns + ["input_tokens", "output_tokens", "calls", "cost_usd"]
+        return [dict(zip(keys, row)) for row in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_usage_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = UsageStore()
+        return _store
+
+
+def record_call(kind, name="", calls=1):
+    """Counts external API calls (Airtable, Sheets, ...) for the current run."""
+    try:
+        get_usage_store().record(kind, model=name, calls=calls)
+    except Exception as e:  # Accounting must never break the caller
+        print(f"Error recording usage: {e}")
+
+
+def over_budget():
+    """True when the restaurant of the current graph run exceeded its budget."""
+    restaurant = current_context()[0]
+    return get_usage_store().over_budget(restaurant)
+
+
+def budget_model():
+    """Model to use for the current run: None (default) or BUDGET_MODEL."""
+    return BUDGET_MODEL if over_budget() else None
+
+
+# ----------------------------------------------------------
+# LangChain callback
+# ----------------------------------------------------------
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Records the token usage of every LLM response and retriever query of a turn."""
+
+    def __init__(self, restaurant, thread_id):
+        self.restaurant = restaurant
+        self.thread_id = thread_id
+        self._nodes = {}  # run_id -> graph node
+
+    def _start(self, run_id, metadata):
+        self._nodes[run_id] = (metadata or {}).get("langgraph_node", "")
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kw):
+        self._start(run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kw):
+        self._start(run_id, metadata)
+
+    def on_retriever_start(self, serialized, query, *, run_id, metadata=None, **kw):
+        self._start(run_id, metadata)
+        self._nodes[run_id] = (self._nodes[run_id], query)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        node = self._nodes.pop(run_id, "")
+        llm_output = response.llm_output or {}
+        model = llm_output.get("model_name", "")
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(
+                    getattr(generation, "message", None), "usage_metadata", None
+                )
+                if usage and usage.get("total_cost") == 0:
+                    # Served from a cache (llm_cassette): LangChain zeroes the
+                    # cost of cached responses, and nothing was spent
+                    return
+                if usage:
+                    input_tokens += usage.get("input_tokens", 0)
+                    output_tokens += usage.get("output_tokens", 0)
+                metadata = getattr(
+                    getattr(generation, "message", None), "response_metadata", {}
+                )
+                model = model or metadata.get("model_name", "")
+        if not input_tokens and "token_usage" in llm_output:
+            input_tokens = llm_output["token_usage"].get("prompt_tokens", 0)
+            output_tokens = llm_output["token_usage"].get("completion_tokens", 0)
+        self._record("llm", model, input_tokens, output_tokens, node)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        node, query = self._nodes.pop(run_id, ("", ""))
+        # The embedding call doesn't report usage; ~4 characters per token
+        self._record("embedding", "text-embedding-3-small", len(query) // 4, 0, node)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._nodes.pop(run_id, None)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._nodes.pop(run_id, None)
+
+    def _record(self, kind, model, input_tokens, output_tokens, node):
+        try:
+            get_usage_store().record(
+                kind,
+                model=model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                restaurant=self.restaurant,
+                thread_id=self.thread_id,
+                node=node,
+            )
+        except Exception as e:
+            print(f"Error recording usage: {e}")
+
+
+def accounted_config(config):
+    """Returns the turn's config with a UsageCallbackHandler added to its callbacks."""
+    configurable = config.get("configurable", {})
+    handler = UsageCallbackHandler(
+        str(configurable.get("restaurant", "")), str(configurable.get("thread_id", ""))
+    )
+    callbacks = list(config.get("callbacks") or [])
+    return {**config, "callbacks": callbacks + [handler]}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "rollup":
+        print("Usage: python accounting.py rollup [columns] [since YYYY-MM-DD]")
+        sys.exit(1)
+    by = sys.argv[2].split(",") if len(sys.argv) > 2 else ["restaurant", "day", "node"]
+    since = sys.argv[3] if len(sys.argv) > 3 else None
+    for row in get_usage_store().rollup(by, since=since):
+        print(json.dumps(row, ensure_ascii=False))
@@ -0,0 +1,261 @@
+# analytics_export.py
+# Incremental columnar export of conversations and reservations for analytics.
+#
+# Each run opens every checkpoint DB read-only and, in one short WAL read
+# transaction (it never blocks the chat path's writers), reads only the
+# checkpoints written since the last run (a rowid high-water mark per DB).
+# Decoding happens after the transaction ends. It then writes Parquet files
+# partitioned by day and restaurant:
+#
+#   data/analytics/messages/day=2025-01-31/restaurant=<email>/part-<run>-<db>.parquet
+#   data/analytics/slots/...          one row per slot change (fill order)
+#   data/analytics/reservations/...   one row per booking state change
+#
+# Run with:  python analytics_export.py [db_path ...]
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from checkpoint_serde import CompactSerializer
+from checkpoint_store import shard_paths
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Only needed by this exporter
+    pyarrow = None
+
+ANALYTICS_DIR = "data/analytics"
+STATE_PATH = os.path.join(ANALYTICS_DIR, "_export_state.json")
+# Same layout as restaurant_graph.get_checkpointer()
+DB_PATH = "data/graphs/your_database_file.db"
+CHECKPOINT_SHARDS = int(os.getenv("CHECKPOINT_SHARDS", "1"))
+
+SLOT_KEYS = ("name", "phone", "email", "persons_number", "date", "time", "requests")
+RESERVATION_KEYS = ("id", "booked_status", "persons_number", "date", "time")
+
+
+def default_db_paths():
+    if CHECKPOINT_SHARDS > 1:
+        return shard_paths(os.path.dirname(DB_PATH), CHECKPOINT_SHARDS)
+    return [DB_PATH]
+
+
+def connect_read_only(db_path):
+    """Read-only connection to a live checkpoint DB (no writes, no schema setup)."""
+    uri = f"{pathlib.Path(db_path).absolute().as_uri()}?mode=ro"
+    return sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None)
+
+
+def _load_state():
+    if not os.path.exists(STATE_PATH):
+        return {}
+    with open(STATE_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_state(state):
+    os.makedirs(ANALYTICS_DIR, exist_ok=True)
+    tmp_path = STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def _message_role(message):
+    if isinstance(message, HumanMessage):
+        return "user"
+    if isinstance(message, ToolMessage):
+        return "tool"
+    if isinstance(message, AIMessage):
+        return "assistant"
+    return type(message).__name__
+
+
+def _tool_success(message):
+    try:
+        return bool(json.loads(message.content).get("success"))
+    except (ValueError, AttributeError):
+        return None
+
+
+# ----------------------------------------------------------
+# Timelines
+# ----------------------------------------------------------
+def _rows_for_checkpoint(thread_id, restaurant, ts, step, values, previous, seen_ids):
+    """
+    Rows of the three tables produced by one checkpoint, compared with the
+    previous checkpoint of the same thread. `seen_ids` is updated in place.
+    """
+    day = ts[:10]
+    base = {"thread_id": thread_id, "restaurant": restaurant, "ts": ts, "day": day}
+    messages, slots, reservations = [], [], []
+
+    for message in values.get("messages", []):
+        if message.id in seen_ids:
+            continue
+        seen_ids.add(message.id)
+        tool_calls = getattr(message, "tool_calls", None) or []
+        messages.append(
+            {
+                **base,
+                "step": step,
+                "message_id": message.id,
+                "role": _message_role(message),
+                "chars": (
+                    len(message.content) if isinstance(message.content, str) else 0
+                ),
+                "tool_calls": ",".join(call["name"] for call in tool_calls),
+                "tool_name": message.name if isinstance(message, ToolMessage) else "",
+                "tool_success": (
+                    _tool_success(message) if isinstance(message, ToolMessage) else None
+                ),
+            }
+        )
+
+    for key in SLOT_KEYS:
+        value, old = values.get(key), previous.get(key)
+        if value not in (None, "") and value != old:
+            slots.append(
+                {
+                    **base,
+                    "step": step,
+                    "slot": key,
+                    "was_empty": old in (None, ""),
+                    "value_chars": len(str(value)),
+                }
+            )
+
+    if any(values.get(key) != previous.get(key) for key in RESERVATION_KEYS):
+        if values.get("id") or previous.get("id"):
+            reservations.append(
+                {
+                    **base,
+                    "step": step,
+                    "reservation_id": values.get("id") or "",
+                    "booked_status": bool(values.get("booked_status")),
+                    "persons_number": values.get("persons_number"),
+                    "reservation_date": values.get("date") or "",
+                    "reservation_time": values.get("time") or "",
+                }
+            )
+    return messages, slots, reservations
+
+
+def export_database(db_path, high_water_mark, serde):
+    """
+    Reads the checkpoints of one DB written after `high_water_mark` (rowid).
+    Returns (tables, new_high_water_mark).
+    """
+    tables = {"messages": [], "slots": [], "reservations": []}
+    conn = connect_read_only(db_path)
+    try:
+        # One short read transaction: the new rows and each thread's baseline
+        # come from the same snapshot, and blobs are decoded after it ends
+        conn.execute("BEGIN")
+        rows = conn.execute(
+            "SELECT rowid, thread_id, type, checkpoint, metadata FROM checkpoints "
+            "WHERE rowid > ? AND checkpoint_ns = '' ORDER BY rowid",
+            (high_water_mark,),
+        ).fetchall()
+        by_thread = defaultdict(list)
+        for row in rows:
+            by_thread[row[1]].append(row)
+        # The thread's last checkpoint exported by an earlier run
+        baselines = {
+            thread_id: conn.execute(
+                "SELECT type, checkpoint FROM checkpoints WHERE thread_id = ? "
+                "AND checkpoint_ns = '' AND rowid <= ? ORDER BY rowid DESC LIMIT 1",
+                (thread_id, high_water_mark),
+            ).fetchone()
+            for thread_id in by_thread
+        }
+        conn.rollback()
+    finally:
+        conn.close()
+
+    for thread_id, thread_rows in by_thread.items():
+        previous, seen_ids = {}, set()
+        baseline = baselines[thread_id]
+        if baseline is not None:
+            previous = serde.loads_typed(baseline)["channel_values"]
+            seen_ids = {m.id for m in previous.get("messages", [])}
+
+        for _, _, type_, blob, metadata in thread_rows:
+            checkpoint = serde.loads_typed((type_, blob))
+            metadata = json.loads(metadata) if metadata else {}
+            values = checkpoint["channel_values"]
+            produced = _rows_for_checkpoint(
+                thread_id,
+                str(metadata.get("restaurant", "")),
+                checkpoint["ts"],
+                metadata.get("step"),
+                values,
+                previous,
+                seen_ids,
+            )
+            for name, table_rows in zip(tables, produced):
+                tables[name].extend(table_rows)
+            previous = values
+    new_mark = rows[-1][0] if rows else high_water_mark
+    return tables, new_mark
+
+
+def write_partitions(tables, part_name, directory=ANALYTICS_DIR):
+    """
+    Writes each table as one Parquet file per (day, restaurant) partition.
+    `part_name` must be unique per run and DB, so runs never overwrite each other.
+    """
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is required for the analytics export.")
+    written = 0
+    for name, rows in tables.items():
+        partitions = defaultdict(list)
+        for row in rows:
+            partitions[(row["day"], row["restaurant"] or "unknown")].append(row)
+        for (day, restaurant), partition_rows in partitions.items():
+            path = os.path.join(
+                directory, name, f"day={day}", f"restaurant={restaurant}"
+            )
+            os.makedirs(path, exist_ok=True)
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pylist(partition_rows),
+                os.path.join(path, f"{part_name}.parquet"),
+            )
+            written += len(partition_rows)
+    return written
+
+
+def run_export(db_paths=None):
+    """
+    Exports everything written since the previous run. The high-water marks are
+    saved only after the files are written, so a failed run is simply repeated.
+    """
+    serde = CompactSerializer()
+    state = _load_state()
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    for db_path in db_paths or default_db_paths():
+        if not os.path.exists(db_path):
+            continue
+        started = time.perf_counter()
+        mark = state.get(db_path, 0)
+        tables, new_mark = export_database(db_path, mark, serde)
+        db_name = os.path.splitext(os.path.basename(db_path))[0]
+        written = write_partitions(tables, f"part-{run_id}-{db_name}")
+        state[db_path] = new_mark
+        _save_state(state)
+        print(
+            f"{db_path}: rowid {mark} -> {new_mark}, {written} rows "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    run_export(sys.argv[1:] or None)
@@ -1,20 +1,29 @@
 import streamlit as st
 import os
+import uuid
 import gspread
 from google.oauth2.service_account import Credentials
 
-# SendGrid imports
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+# Onboarding sheet access (row index + batched writes)
+from sheet_repository import OnboardingSheet
+from tenant_registry import NO_EXTRA_INFO, get_tenant_registry
+
+# Shared keep-alive pools for the external APIs
+from connection_pools import adopt_session, prewarm_on_start
+
+# RSS sampling and periodic allocation reports (data/diagnostics)
+from memory_diagnostics import start_memory_profiler
+
+# Background email dispatch (persistent SendGrid client)
+from email_queue import get_email_dispatcher
 
 # Environment variables
 from dotenv import load_dotenv
 
 load_dotenv()
-SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 
 # LLM call
-from restaurant_graph import call_model
+from restaurant_graph import call_model, get_history, get_react_graph
 
 # Import your email templates
 from emails_templates import asunto_1, mensaje_1_html, mensaje_1_plain
@@ -22,38 +31,65 @@ from emails_templates import asunto_1, mensaje_1_html, mensaje_1_plain
 # Google Sheet ID (extracted from your provided URL)
 SHEET_ID = "1KkUROgG1enUbg4KYEJhgmZ8sT7nGCCaN3p8w-mRfxmE"
 
+# Chat messages rendered per "load older" page
+HISTORY_PAGE_SIZE = 20
+
+
+# ----------------------------------------------------------
+# Cached resources (shared by every session of this process)
+# ----------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def get_graph():
+    # Compiles the graph and opens the checkpointer once per process
+    prewarm_on_start()
+    start_memory_profiler()
+    return get_react_graph()
+
+
+@st.cache_resource(show_spinner=False)
+def get_email_queue():
+    # Starts the dispatcher thread once per process
+    return get_email_dispatcher()
+
 
 # ----------------------------------------------------------
 # Google Sheets Functions
 # ----------------------------------------------------------
+@st.cache_resource(show_spinner=False)
 def get_gspread_client():
     json_path = os.getenv(
         "GOOGLE_CREDENTIALS_JSON", "data/spreadsheet-demo-for-hr-9cf643c81c21.json"
     )
     if os.path.exists(json_path):
         client = gspread.service_account(filename=json_path)
-        return client
     else:
         creds_dict = st.secrets["GOOGLE_SERVICE_ACCOUNT"]
         creds = Credentials.from_service_account_info(
             creds_dict, scopes=["https://www.googleapis.com/auth/spreadsheets"]
         )
         client = gspread.authorize(creds)
-        return client
+    # gspread >= 6 keeps its session on client.http_client
+    adopt_session("sheets", getattr(client, "http_client", client).session)
+    return client
 
 
+@st.cache_resource(show_spinner=False)
 def get_sheet():
     client = get_gspread_client()
     sheet = client.open_by_key(SHEET_ID).sheet1
     return sheet
 
 
+@st.cache_resource(show_spinner=False)
+def get_onboarding_sheet():
+    # One row index and write queue per process, shared by every session
+    return OnboardingSheet(get_sheet())
+
+
 def get_restaurant_data(email):
-    sheet = get_sheet()
-    cell = sheet.find(email)
-    if cell is None:
+    row_values = get_onboarding_sheet().get(email)
+    if row_values is None:
         return None
-    row_values = sheet.row_values(cell.row)
     while len(row_values) < 6:
         row_values.append("")
     try:
@@ -64,10 +100,8 @@ def get_restaurant_data(email):
 
 
 def insert_placeholder_email(email):
-    if get_restaurant_data(email) is None:
-        sheet = get_sheet()
-        new_row = [email, "", "", "", "", "0"]
-        sheet.append_row(new_row)
+    # Queued: merged with the form submission if it arrives before the flush
+    get_onboarding_sheet().insert_placeholder(email, defer=True)
 
 
 def mark_form_completed(email, info_general, preguntas_frecuentes, info_adicional):
@@ -79,60 +113,56 @@ def mark_form_completed(email, info_general, preguntas_frecuentes, info_adiciona
       - Column4: información_adicional
       - Column5: se deja vacío (puedes modificarlo según lo requieras)
     """
-    sheet = get_sheet()
-    try:
-        cell = sheet.find(email)
-        row_number = cell.row
-        updated_row = [
-            email,
-            info_general,
-            preguntas_frecuentes,
-            info_adicional,
-            "",  # Puedes dejar este campo vacío o asignarle otro valor
-            "1",
-        ]
-        cell_range = f"A{row_number}:F{row_number}"
-        sheet.update(cell_range, [updated_row])
-    except gspread.exceptions.CellNotFound:
-        new_row = [
-            email,
-            info_general,
-            preguntas_frecuentes,
-            info_adicional,
-            "",
-            "1",
-        ]
-        sheet.append_row(new_row)
+    updated_row = [
+        email,
+        info_general,
+        preguntas_frecuentes,
+        info_adicional,
+        "",  # Puedes dejar este campo vacío o asignarle otro valor
+        "1",
+    ]
+    get_onboarding_sheet().upsert(email, updated_row)
+    # New profile version; replaces only this restaurant's cached prompt block
+    get_tenant_registry().publish(email, updated_row)
 
 
 # ----------------------------------------------------------
 # Email Sending & Navigation Functions
 # ----------------------------------------------------------
 def enviar_correo(recipient, subject, html_content, plain_text=None):
-    message = Mail(
-        from_email="Alex de AutoFlujo Star <alex@autoflujo.com>",
-        to_emails=recipient,
-        subject=subject,
-        html_content=html_content,
-    )
-    if plain_text:
-        message.plain_text_content = plain_text
-
+    # Returns the job id as soon as the email is queued (None if it couldn't be);
+    # delivery and retries run in background
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
-        print(f"Email sent! Status Code: {response.status_code}")
-        return response.status_code
+        return get_email_queue().enqueue(recipient, subject, html_content, plain_text)
     except Exception as e:
-        print("Error:", str(e))
+        print(f"Error queueing email to {recipient}: {e}")
         return None
 
 
+def get_restaurant_context(email):
+    """
+    Returns the restaurant block of the agent prompt (latest profile version).
+    Restaurants onboarded before the registry are published from the sheet once.
+    """
+    tenant = get_tenant_registry().get(email)
+    if tenant is None:
+        data = get_restaurant_data(email)
+        if not data:
+            return None
+        tenant = get_tenant_registry().publish(email, data)
+    return tenant.fragment
+
+
 def go_to(page_name):
     st.session_state["page"] = page_name
     st.rerun()
 
 
+def new_submission_id():
+    """chat_input callback: identifies one send for turn deduplication."""
+    st.session_state["submission_id"] = uuid.uuid4().hex
+
+
 # ----------------------------------------------------------
 # Page Functions
 # ----------------------------------------------------------
@@ -153,16 +183,20 @@ def pagina_home():
                 else:
                     go_to("formulario")
             else:
-                status = enviar_correo(
+                job_id = enviar_correo(
                     recipient=email_input.strip(),
                     subject=asunto_1,
                     html_content=mensaje_1_html,
                     plain_text=mensaje_1_plain,
                 )
-                if status == 202:
-                    st.success("¡Cargando tu información, espera un momento!")
-                else:
-                    st.warning("No se pudo enviar el correo de bienvenida.")
+                if job_id is None:
+                    # Stay here so "Continuar" tries again
+                    st.error(
+                        "No pudimos enviarte el correo de bienvenida. "
+                        "Intenta de nuevo en un momento."
+                    )
+                    return
+                st.success("¡Cargando tu información, espera un momento!")
                 insert_placeholder_email(email_input.strip())
                 go_to("formulario")
         else:
@@ -255,11 +289,7 @@ def pagina_formulario():
                 email_user.strip(),
                 info_general_str,
                 preguntas_frecuentes_str,
-                (
-                    info_adicional
-                    if info_adicional.strip()
-                    else "No se agregó información adicional."
-                ),
+                info_adicional if info_adicional.strip() else NO_EXTRA_INFO,
             )
             st.success("¡Información guardada exitosamente!")
             go_to("chat")
@@ -289,35 +319,42 @@ def pagina_chat():
         st.warning("No email found. Regresa al Inicio.")
         return
 
-    data = get_restaurant_data(email_user.strip())
-    if not data:
+    restaurant_data = get_restaurant_context(email_user.strip())
+    if not restaurant_data:
         st.warning("No hay datos en la hoja. Regresa al Inicio.")
         return
 
-    restaurant_data = f"""--- RESTAURANT DATA ---
-Información Básica:
-{data[1]}
-
-Preguntas Frecuentes:
-{data[2]}
-
-Información Adicional:
-{data[3]}
--------------------------
-"""
-
-    config_dict = {"configurable": {"thread_id": email_user}}
-
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = []
-
-    for msg in st.session_state["messages"]:
+    # "restaurant" attributes token usage and budgets to this tenant (accounting.py)
+    config_dict = {"configurable": {"thread_id": email_user, "restaurant": email_user}}
+
+    # Render only the latest pages of the transcript stored with the checkpointer
+    if st.session_state.get("history_thread") != email_user:
+        st.session_state["history_thread"] = email_user
+        st.session_state["history_pages"] = 1
+
+    history = []
+    before = None
+    for _ in range(st.session_state["history_pages"]):
+        page = get_history(email_user, before=before, limit=HISTORY_PAGE_SIZE)
+        if not page:
+            break
+        history = page + history
+        before = page[0]["seq"]
+
+    if before is not None and get_history(email_user, before=before, limit=1):
+        if st.button("Cargar mensajes anteriores"):
+            st.session_state["history_pages"] += 1
+            st.rerun()
+
+    for msg in history:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
 
-    if user_input := st.chat_input("Escribe tu mensaje..."):
-        user_message = {"role": "user", "content": user_input}
-        st.session_state["messages"].append(user_message)
+    # New id per submission (the callback runs once per send, not per rerun), so
+    # a rerun of the same submission reuses the reply and a repeated "sí" doesn't
+    if user_input := st.chat_input(
+        "Escribe tu mensaje...", on_submit=new_submission_id
+    ):
         with st.chat_message("user"):
             st.markdown(user_input)
 
@@ -326,9 +363,8 @@ Información Adicional:
             phone=email_user,
             restaurant_data=restaurant_data,
             config=config_dict,
+            idempotency_key=f"{email_user}:{st.session_state['submission_id']}",
         )
-        assistant_message = {"role": "assistant", "content": response_text}
-        st.session_state["messages"].append(assistant_message)
         with st.chat_message("assistant"):
             st.markdown(response_text)
 
@@ -353,6 +389,9 @@ def add_logo_and_footer():
 def main():
     add_logo_and_footer()
 
+    # Warm the compiled graph once per process (no-op on later reruns)
+    get_graph()
+
     if "page" not in st.session_state:
         st.session_state["page"] = "home"
 
@@ -0,0 +1,254 @@
+# availability.py
+# In-memory capacity index of a restaurant's reservations.
+#
+# Every reservation occupies the time buckets of its stay (DINING_MINUTES from
+# its start). The index keeps the seats taken per bucket, so checking a slot is a
+# handful of dict lookups no matter how many reservations exist, and nearby
+# free slots can be suggested without calling Airtable. The index is loaded once
+# from the reservations table and then kept current by the reservation tools.
+#
+# Only capacity is checked here. Opening hours are each restaurant's free-text
+# schedule from the onboarding form, which the agent reads in its prompt.
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+RESTAURANT_TIMEZONE = "America/Mexico_City"
+SLOT_MINUTES = 30
+# Alternatives are looked for this far before and after the requested time
+SUGGEST_WINDOW_MINUTES = 120
+# How long a table stays taken after the reservation time
+DINING_MINUTES = int(os.getenv("AVAILABILITY_DINING_MINUTES", "90"))
+# Seats the restaurant can seat at the same time
+DEFAULT_CAPACITY = int(os.getenv("AVAILABILITY_CAPACITY", "60"))
+# Reload from Airtable after this many seconds (staff also edit the table)
+RELOAD_SECONDS = int(os.getenv("AVAILABILITY_RELOAD_SECONDS", "900"))
+
+
+def parse_utc(value):
+    """'2024-12-02T20:30:00.000Z' -> aware UTC datetime."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(pytz.utc)
+
+
+class CapacityIndex:
+    """
+    Seats taken per SLOT_MINUTES bucket for one restaurant.
+
+    Args:
+        capacity: Seats available at the same time.
+        timezone: Local timezone of the opening hours.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, timezone=RESTAURANT_TIMEZONE):
+        self.capacity = capacity
+        self.tz = pytz.timezone(timezone)
+        self._lock = threading.Lock()
+        self._taken = {}  # bucket -> seats
+        self._reservations = {}  # record_id -> (start UTC datetime, persons)
+        self._holds = 0
+        # record_id -> ((start, persons) or None when cancelled, monotonic time)
+        # of changes made by the tools, replayed over a reload that read the
+        # table before them
+        self._changes = {}
+        self.loaded_at = None
+
+    # ------------------------------------------------------
+    # Buckets
+    # ------------------------------------------------------
+    @staticmethod
+    def _buckets(start):
+        first = int(start.timestamp()) // (SLOT_MINUTES * 60)
+        count = max(1, -(-DINING_MINUTES // SLOT_MINUTES))
+        return range(first, first + count)
+
+    def _fits(self, start, persons, ignore=None):
+        released = {}
+        if ignore in self._reservations:
+            ignored_start, ignored_persons = self._reservations[ignore]
+            released = {b: ignored_persons for b in self._buckets(ignored_start)}
+        return all(
+            self._taken.get(b, 0) - released.get(b, 0) + persons <= self.capacity
+            for b in self._buckets(start)
+        )
+
+    def _add(self, record_id, start, persons):
+        self._reservations[record_id] = (start, persons)
+        for b in self._buckets(start):
+            self._taken[b] = self._taken.get(b, 0) + persons
+
+    def _remove(self, record_id):
+        entry = self._reservations.pop(record_id, None)
+        if entry is None:
+            return
+        start, persons = entry
+        for b in self._buckets(start):
+            seats = self._taken.get(b, 0) - persons
+            if seats > 0:
+                self._taken[b] = seats
+            else:
+                self._taken.pop(b, None)
+
+    # ------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------
+    def load(self, records, fetched_at=None):
+        """
+        Rebuilds the index from Airtable records (cancelled ones are skipped).
+
+        Holds still in flight are kept, and changes committed after
+        `fetched_at` (when the records were read) are applied again.
+        """
+        with self._lock:
+            holds = {
+                hold_id: entry
+                for hold_id, entry in self._reservations.items()
+                if hold_id.startswith("hold-")
+            }
+            self._taken, self._reservations = {}, {}
+            for record in records:
+                fields = record.get("fields", {})
+                if fields.get("Estatus") == "Cancelada" or not fields.get(
+                    "Fecha y Hora"
+                ):
+                    continue
+                try:
+                    start = parse_utc(fields["Fecha y Hora"])
+                    persons = int(fields.get("Nº Personas") or 0)
+                except ValueError:
+                    continue
+                self._add(record["id"], start, persons)
+            for hold_id, entry in holds.items():
+                self._add(hold_id, *entry)
+            if fetched_at is not None:
+                for record_id, (entry, changed_at) in list(self._changes.items()):
+                    if changed_at < fetched_at:
+                        del self._changes[record_id]
+                        continue
+                    self._remove(record_id)
+                    if entry is not None:
+                        self._add(record_id, *entry)
+            self.loaded_at = time.monotonic()
+
+    # ------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------
+    def check(self, start, persons, ignore=None):
+        """
+        Returns (available, reason). `ignore` is a record_id whose seats don't
+        count (the reservation being changed).
+        """
+        with self._lock:
+            if self._fits(start, persons, ignore):
+                return True, ""
+        return False, "No hay lugar para ese número de personas a esa hora."
+
+    def suggest(self, start, persons, limit=3, ignore=None):
+        """
+        Free slots of the same day within SUGGEST_WINDOW_MINUTES of `start`,
+        closest first, as local 'HH:MM' strings.
+        """
+        local = start.astimezone(self.tz)
+        steps = SUGGEST_WINDOW_MINUTES // SLOT_MINUTES
+        slots = [
+            self.tz.normalize(local + timedelta(minutes=SLOT_MINUTES * step))
+            for step in range(-steps, steps + 1)
+        ]
+        slots = [slot for slot in slots if slot.date() == local.date()]
+        slots.sort(key=lambda slot: abs((slot - local).total_seconds()))
+
+        now = datetime.now(pytz.utc)
+        suggestions = []
+        with self._lock:
+            for slot in slots:
+                if slot > now and slot != local and self._fits(slot, persons, ignore):
+                    suggestions.append(slot.strftime("%H:%M"))
+                    if len(suggestions) == limit:
+                        break
+        return sorted(suggestions)
+
+    # ------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------
+    def hold(self, start, persons, ignore=None):
+        """
+        Reserves the seats while the Airtable write runs, so two bookings can't
+        both pass the check for the last free seats. Returns a hold id, or None
+        when the slot is full. Finish with commit() or release().
+        """
+        with self._lock:
+            if not self._fits(start, persons, ignore):
+                return None
+            self._holds += 1
+            hold_id = f"hold-{self._holds}"
+            self._add(hold_id, start, persons)
+            return hold_id
+
+    def commit(self, hold_id, record_id):
+        with self._lock:
+            entry = self._reservations.get(hold_id)
+            if entry is None:
+                return
+            self._remove(hold_id)
+            self._remove(record_id)  # Previous time/size of an updated reservation
+            self._add(record_id, *entry)
+            self._changes[record_id] = (entry, time.monotonic())
+
+    def release(self, hold_id):
+        with self._lock:
+            self._remove(hold_id)
+
+    def cancel(self, record_id):
+        with self._lock:
+            self._remove(record_id)
+            self._changes[record_id] = (None, time.monotonic())
+
+    def get(self, record_id):
+        """(start, persons) of a reservation known to the index, or None."""
+        with self._lock:
+            return self._reservations.get(record_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "reservations": len(self._reservations),
+                "busy_buckets": len(self._taken),
+                "capacity": self.capacity,
+            }
+
+
+# ----------------------------------------------------------
+# One index per restaurant (reservations table)
+# ----------------------------------------------------------
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_capacity_index(restaurant_key, loader, capacity=DEFAULT_CAPACITY):
+    """
+    Returns the index of a restaurant, loading or reloading it when needed.
+
+    A failed reload keeps serving the previous data. When the index was never
+    loaded it returns None, and callers skip the capacity check rather than
+    refusing every booking while Airtable is down.
+
+    Args:
+        restaurant_key: Identifies the restaurant (its reservations table).
+        loader: Callable returning the table's records, used on (re)load.
+        capacity: Seats of the restaurant, used when the index is created.
+    """
+    with _indexes_lock:
+        index = _indexes.get(restaurant_key)
+        if index is None:
+            index = _indexes[restaurant_key] = CapacityIndex(capacity)
+    if index.loaded_at is None or time.monotonic() - index.loaded_at > RELOAD_SECONDS:
+        fetched_at = time.monotonic()
+        try:
+            index.load(loader(), fetched_at)
+        except Exception as e:
+            print(f"Error loading reservations for the capacity index: {e}")
+            if index.loaded_at is None:
+                return None
+    return index
@@ -0,0 +1,473 @@
+# benchmarks.py
+"""Local benchmarks. Run one with:  python benchmarks.py <name> [--param key=value]"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+# ----------------------------------------------------------
+# Messenger webhook load test
+# ----------------------------------------------------------
+def bench_messenger(
+    chats=300,
+    messages_per_chat=3,
+    turn_latency=0.5,
+    max_workers=64,
+    coalesce_window=1.5,
+):
+    """
+    Drives messenger_server's ASGI app in-process with `chats` concurrent
+    conversations. Graph turns are simulated with a sleep of ~turn_latency seconds,
+    so this measures the server (ack latency, throughput, ordering, coalescing),
+    not the LLM.
+    """
+    from messenger_server import StubSender, TurnDispatcher, create_app
+
+    sender = StubSender(verbose=False)
+
+    def fake_turn(thread_id, texts):
+        time.sleep(turn_latency * random.uniform(0.5, 1.5))
+        return " | ".join(texts)
+
+    app = create_app(
+        lambda: TurnDispatcher(
+            fake_turn,
+            sender,
+            max_workers=max_workers,
+            coalesce_window=coalesce_window,
+        ),
+        verify_token="bench",
+    )
+
+    async def post(payload):
+        body = json.dumps(payload).encode()
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        status = {}
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(event):
+            if event["type"] == "http.response.start":
+                status["code"] = event["status"]
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/webhook",
+            "query_string": b"",
+        }
+        started = time.perf_counter()
+        await app(scope, receive, send)
+        return time.perf_counter() - started, status["code"]
+
+    async def chat(phone):
+        acks = []
+        for i in range(messages_per_chat):
+            payload = {
+                "entry": [
+                    {
+                        "changes": [
+                            {
+                                "value": {
+                                    "messages": [
+                                        {
+                                            "from": phone,
+                                            "id": f"{phone}-{i}",
+                                            "type": "text",
+                                            "text": {"body": f"msg {i}"},
+                                        }
+                                    ]
+                                }
+                            }
+                        ]
+                    }
+                ]
+            }
+            acks.append(await post(payload))
+            await asyncio.sleep(random.uniform(0.0, 0.2))
+        return acks
+
+    async def run():
+        dispatcher = app.get_dispatcher()
+        started = time.perf_counter()
+        results = await asyncio.gather(*(chat(f"52155{n:08d}") for n in range(chats)))
+        ack_done = time.perf_counter() - started
+        while dispatcher.pending:
+            await asyncio.sleep(0.05)
+        total = time.perf_counter() - started
+        await dispatcher.stop()
+        return results, ack_done, total, dispatcher.snapshot()
+
+    results, ack_done, total, snapshot = asyncio.run(run())
+    ack_latencies = [latency for acks in results for latency, _ in acks]
+
+    # Replies must come back in the order each chat sent its messages
+    replies = {}
+    for _, thread_id, text in sender.sent:
+        replies.setdefault(thread_id, []).append(text)
+    in_order = True
+    for texts in replies.values():
+        numbers = [
+            int(part.split()[-1]) for text in texts for part in text.split(" | ")
+        ]
+        in_order = in_order and numbers == sorted(numbers)
+
+    print(f"chats={chats} messages={len(ack_latencies)} workers={max_workers}")
+    print(
+        f"ack p50={statistics.median(ack_latencies) * 1000:.2f}ms "
+        f"p99={_percentile(ack_latencies, 99) * 1000:.2f}ms "
+        f"(all acks in {ack_done:.2f}s)"
+    )
+    print(f"all turns done in {total:.2f}s; replies in order: {in_order}")
+    print(f"dispatcher: {snapshot}")
+
+
+# ----------------------------------------------------------
+# Checkpoint serialization
+# ----------------------------------------------------------
+# A booking conversation as the graph stores it: varied customer messages, the
+# retriever and reservation tool calls, and OpenAI metadata on every AI message.
+# (role, content, tool call name, tool call args, tool result)
+TRANSCRIPT = [
+    ("human", "Hola buenas tardes", None, None, None),
+    (
+        "ai",
+        "¡Hola! Bienvenido a Restaurante La Terraza. ¿En qué te puedo ayudar hoy?",
+        None,
+        None,
+        None,
+    ),
+    (
+        "human",
+        "Tienen opciones vegetarianas? vamos con una amiga que no come carne",
+        None,
+        None,
+        None,
+    ),
+    (
+        "ai",
+        "",
+        "menu_retriever_tool",
+        {"query": "platillos vegetarianos"},
+        "Ensalada de betabel rostizado con queso de cabra, nuez garapiñada y "
+        "vinagreta de naranja. $185\n\nTacos de hongos al pastor (3 piezas) con "
+        "piña asada, cebolla y cilantro. $165\n\nRisotto de flor de calabaza y "
+        "elote con parmesano. $240\n\nEnchiladas suizas de espinaca con crema y "
+        "queso gratinado. $195",
+    ),
+    (
+        "ai",
+        "¡Claro! Tenemos varias opciones vegetarianas: la ensalada de betabel "
+        "rostizado, los tacos de hongos al pastor, el risotto de flor de calabaza "
+        "y las enchiladas suizas de espinaca. ¿Te gustaría hacer una reservación?",
+        None,
+        None,
+        None,
+    ),
+    ("human", "Si, para el sábado a las 8:30 pm", None, None, None),
+    (
+        "ai",
+        "Perfecto. ¿Para cuántas personas sería y a nombre de quién?",
+        None,
+        None,
+        None,
+    ),
+    ("human", "Somos 5, a nombre de Ana del Valle", None, None, None),
+    (
+        "ai",
+        "",
+        "consultar_disponibilidad",
+        {"fecha": "2024-12-07", "hora": "20:30", "numero_personas": 5},
+        {"available": True},
+    ),
+    (
+        "ai",
+        "Sí tenemos lugar para 5 personas el sábado 7 de diciembre a las 8:30 pm. "
+        "¿Me compartes un teléfono y un correo para confirmarte?",
+        None,
+        None,
+        None,
+    ),
+    (
+        "human",
+        "5555555555 y ana_v@example.com, ah y evitar mariscos porfa",
+        None,
+        None,
+        None,
+    ),
+    (
+        "ai",
+        "",
+        "add_user_to_restaurant_db",
+        {
+            "nombre": "Ana del Valle",
+            "telefono": "5555555555",
+            "email": "ana_v@example.com",
+            "fecha": "2024-12-07",
+            "hora": "20:30",
+            "numero_personas": 5,
+            "notes": "Evitar mariscos",
+        },
+        {
+            "success": True,
+            "record": {
+                "id": "recA1b2C3d4E5f6G7",
+                "createdTime": "2024-12-02T20:30:00.000Z",
+                "fields": {
+                    "Nombre": "Ana del Valle",
+                    "Teléfono": "5555555555",
+                    "Email": "ana_v@example.com",
+                    "Fecha y Hora": "2024-12-08T02:30:00.000Z",
+                    "Nº Personas": 5,
+                    "Estatus": "Recibida",
+                    "Notes": "Evitar mariscos",
+                },
+            },
+        },
+    ),
+    (
+        "ai",
+        "¡Listo, Ana! Tu reservación para 5 personas el sábado 7 de diciembre a "
+        "las 8:30 pm quedó registrada. Anotamos que eviten mariscos.",
+        None,
+        None,
+        None,
+    ),
+    ("human", "Una pregunta, hay estacionamiento?", None, None, None),
+    (
+        "ai",
+        "",
+        "general_retriever_tool",
+        {"query": "estacionamiento"},
+        "Contamos con servicio de valet parking de jueves a domingo a partir de "
+        "las 18:00 horas con un costo de $60. Entre semana hay estacionamiento "
+        "público a media cuadra sobre la calle Durango.",
+    ),
+    (
+        "ai",
+        "Sí, tenemos valet parking de jueves a domingo desde las 6 pm ($60). "
+        "¿Te ayudo con algo más?",
+        None,
+        None,
+        None,
+    ),
+    ("human", "Nada más, muchas gracias!", None, None, None),
+    ("ai", "¡Con gusto! Te esperamos el sábado. 😊", None, None, None),
+]
+
+
+def _transcript_checkpoints():
+    """Checkpoint after every message of TRANSCRIPT, like the graph writes them."""
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+    messages = []
+    checkpoints = []
+    for number, (role, content, tool, args, result) in enumerate(TRANSCRIPT):
+        openai_metadata = {
+            "token_usage": {
+                "completion_tokens": 20 + 7 * number,
+                "prompt_tokens": 1400 + 95 * number,
+                "total_tokens": 1420 + 102 * number,
+            },
+            "model_name": "gpt-4o-mini-2024-07-18",
+            "system_fingerprint": "fp_0ba0d124f1",
+            "finish_reason": "tool_calls" if tool else "stop",
+            "logprobs": None,
+        }
+        if role == "human":
+            messages.append(HumanMessage(content=content))
+        elif tool is None:
+            messages.append(
+                AIMessage(
+                    content=content,
+                    additional_kwargs={"refusal": None},
+                    response_metadata=openai_metadata,
+                )
+            )
+        else:
+            call_id = f"call_{number:04d}Xq81LmZ"
+            messages.append(
+                AIMessage(
+                    content="",
+                    tool_calls=[{"name": tool, "args": args, "id": call_id}],
+                    additional_kwargs={
+                        "tool_calls": [
+                            {
+                                "id": call_id,
+                                "function": {
+                                    "name": tool,
+                                    "arguments": json.dumps(args),
+                                },
+                                "type": "function",
+                            }
+                        ],
+                        "refusal": None,
+                    },
+                    response_metadata=openai_metadata,
+                )
+            )
+            messages.append(
+                ToolMessage(
+                    content=(
+                        result
+                        if isinstance(result, str)
+                        else json.dumps(result, ensure_ascii=False, indent=1)
+                    ),
+                    name=tool,
+                    tool_call_id=call_id,
+                )
+            )
+        checkpoints.append(
+            {
+                "v": 1,
+                "id": f"1ef4f797-8335-6428-8001-{number:012d}",
+                "ts": "2024-12-02T20:30:00+00:00",
+                "channel_values": {
+                    "messages": list(messages),
+                    "name": "Ana del Valle",
+                    "booked_status": number >= 11,
+                },
+                "channel_versions": {"messages": f"{number:032d}.0.1"},
+                "versions_seen": {},
+            }
+        )
+    return checkpoints
+
+
+def bench_checkpoint_serde(db_path="data/graphs/your_database_file.db", limit=500):
+    """
+    Bytes per checkpoint and encode/decode time of the LangGraph default
+    serializer vs CompactSerializer. Uses the checkpoints in db_path when it has
+    any, otherwise the checkpoints of TRANSCRIPT.
+    """
+    import os
+    import sqlite3
+
+    from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+    from checkpoint_serde import CompactSerializer
+
+    default, compact = JsonPlusSerializer(), CompactSerializer()
+
+    checkpoints = []
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT type, checkpoint FROM checkpoints ORDER BY rowid DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        conn.close()
+        checkpoints = [compact.loads_typed((type_, blob)) for type_, blob in rows]
+    source = db_path if checkpoints else "TRANSCRIPT"
+    if not checkpoints:
+        checkpoints = _transcript_checkpoints()
+
+    print(f"{len(checkpoints)} checkpoints from {source}")
+    for name, serde in (("default", default), ("compact", compact)):
+        started = time.perf_counter()
+        encoded = [serde.dumps_typed(checkpoint) for checkpoint in checkpoints]
+        encode_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for data in encoded:
+            serde.loads_typed(data)
+        decode_time = time.perf_counter() - started
+
+        sizes = [len(data) for _, data in encoded]
+        print(
+            f"{name:8s} avg={statistics.mean(sizes):10,.0f} B  "
+            f"max={max(sizes):10,} B  "
+            f"encode={encode_time / len(encoded) * 1e6:8.1f} us  "
+            f"decode={decode_time / len(encoded) * 1e6:8.1f} us"
+        )
+
+
+# ----------------------------------------------------------
+# Import time
+# ----------------------------------------------------------
+def bench_import(modules="agents,restaurant_graph", repeats=5, top=10):
+    """
+    Cold import time of each module, measured in fresh interpreters (median of
+    `repeats`), plus the slowest imports it pulls in according to -X importtime.
+    """
+    import subprocess
+    import sys
+
+    for module in modules.split(","):
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import time; started = time.perf_counter(); "
+                    f"import {module}; print(time.perf_counter() - started)",
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            timings.append(float(output.strip().splitlines()[-1]))
+        print(
+            f"{module}: median={statistics.median(timings) * 1000:.0f} ms  "
+            f"min={min(timings) * 1000:.0f} ms  ({repeats} runs)"
+        )
+
+        # "import time: self [us] | cumulative | imported package" on stderr
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        cumulative = []
+        for line in stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                if parts[2].strip() != module:
+                    cumulative.append((int(parts[1]), parts[2].strip()))
+        for micros, name in sorted(cumulative, reverse=True)[:top]:
+            print(f"  {micros / 1000:8.1f} ms  {name}")
+
+
+BENCHMARKS = {
+    "messenger": bench_messenger,
+    "checkpoint_serde": bench_checkpoint_serde,
+    "import": bench_import,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="Benchmark keyword argument as key=value (value parsed as JSON when possible)",
+    )
+    args = parser.parse_args()
+
+    kwargs = {}
+    for param in args.param:
+        key, _, value = param.partition("=")
+        try:
+            kwargs[key] = json.loads(value)
+        except json.JSONDecodeError:
+            kwargs[key] = value
+    BENCHMARKS[args.name](**kwargs)
@@ -0,0 +1,116 @@
+# chat_history.py
+# Append-only chat transcript per thread, read in pages.
+#
+# The graph state only keeps the messages that survived summarize_conversation,
+# so the full user-facing transcript lives here. Threads that existed before this
+# table are backfilled once from the checkpoint history (see restaurant_graph.get_history).
+import os
+import sqlite3
+import threading
+import time
+
+HISTORY_DB_PATH = "data/graphs/chat_history.db"
+
+_lock = threading.Lock()
+_conn = None
+
+
+def get_connection():
+    global _conn
+    with _lock:
+        if _conn is None:
+            os.makedirs(os.path.dirname(HISTORY_DB_PATH), exist_ok=True)
+            conn = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS transcript (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    thread_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_transcript_thread "
+                "ON transcript (thread_id, seq)"
+            )
+            # Threads whose transcript is complete (backfilled or started here)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcript_threads (thread_id TEXT PRIMARY KEY)"
+            )
+            conn.commit()
+            _conn = conn
+        return _conn
+
+
+def has_thread(thread_id):
+    conn = get_connection()
+    with _lock:
+        row = conn.execute(
+            "SELECT 1 FROM transcript_threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+    return row is not None
+
+
+def backfill(thread_id, messages):
+    """
+    Marks the thread as tracked and stores its earlier messages.
+
+    Args:
+        thread_id: Conversation thread.
+        messages: List of (role, content) tuples, oldest first.
+    """
+    conn = get_connection()
+    now = time.time()
+    with _lock:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO transcript_threads (thread_id) VALUES (?)",
+            (thread_id,),
+        ).rowcount
+        if inserted:
+            conn.executemany(
+                "INSERT INTO transcript (thread_id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(thread_id, role, content, now) for role, content in messages],
+            )
+        conn.commit()
+
+
+def record_messages(thread_id, messages):
+    """Appends (role, content) tuples to the thread transcript."""
+    conn = get_connection()
+    now = time.time()
+    rows = [(thread_id, role, content, now) for role, content in messages if content]
+    with _lock:
+        conn.execute(
+            "INSERT OR IGNORE INTO transcript_threads (thread_id) VALUES (?)",
+            (thread_id,),
+        )
+        conn.executemany(
+            "INSERT INTO transcript (thread_id, role, content, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+
+
+def get_page(thread_id, before=None, limit=20):
+    """
+    Returns up to `limit` messages older than the `before` cursor, oldest first.
+
+    Each message is a dict with "seq", "role" and "content". Pass the "seq" of the
+    first message of a page as `before` to get the previous page.
+    """
+    conn = get_connection()
+    query = "SELECT seq, role, content FROM transcript WHERE thread_id = ?"
+    params = [thread_id]
+    if before is not None:
+        query += " AND seq < ?"
+        params.append(before)
+    query += " ORDER BY seq DESC LIMIT ?"
+    params.append(limit)
+    with _lock:
+        rows = conn.execute(query, params).fetchall()
+    return [
+        {"seq": seq, "role": role, "content": content}
+        for seq, role, content in reversed(rows)
+    ]
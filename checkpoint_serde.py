@@ -0,0 +1,186 @@
+# checkpoint_serde.py
+# Compact checkpoint serializer: slimmer messages + compression chosen by size.
+#
+# Checkpoints are written several times per turn and carry the whole message
+# history, including OpenAI response metadata and ToolMessages with full Airtable
+# records. CompactSerializer drops what the graph never reads back, encodes with
+# the regular msgpack format and compresses payloads above a size threshold. The
+# codec is recorded in the type tag ("msgpack+zlib"), so rows written by the
+# default serializer stay readable and both formats can live in the same DB.
+# Plain JsonPlusSerializer can't read the compressed rows; PlainSerializer writes
+# the default format and still reads them, so switching back is safe.
+#
+# Migrate an existing DB with:  python checkpoint_serde.py migrate data/graphs/*.db
+import json
+import sqlite3
+import sys
+import zlib
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+try:
+    import zstandard
+except ImportError:  # Optional: zlib is used when zstandard isn't installed
+    zstandard = None
+
+# Payloads smaller than this are stored uncompressed (not worth the CPU)
+COMPRESS_MIN_BYTES = 512
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# response_metadata keys worth keeping (analytics reads the model name)
+KEPT_RESPONSE_METADATA = ("model_name", "finish_reason")
+
+
+def _decompress(data, zstd_decompressor=None):
+    """("msgpack+zstd", payload) -> ("msgpack", decompressed payload)."""
+    type_, payload = data
+    base_type, _, codec = type_.partition("+")
+    if codec == "zlib":
+        payload = zlib.decompress(payload)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this checkpoint.")
+        payload = (zstd_decompressor or zstandard.ZstdDecompressor()).decompress(
+            payload
+        )
+    elif codec:
+        raise ValueError(f"Unknown checkpoint codec: {codec}")
+    return base_type, payload
+
+
+class PlainSerializer(JsonPlusSerializer):
+    """LangGraph's default format that still reads rows written compact."""
+
+    def loads_typed(self, data):
+        return super().loads_typed(_decompress(data))
+
+
+class CompactSerializer(JsonPlusSerializer):
+    def __init__(self, *args, compress_min_bytes=COMPRESS_MIN_BYTES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress_min_bytes = compress_min_bytes
+        if zstandard is not None:
+            self._zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+
+    def dumps_typed(self, obj):
+        type_, data = super().dumps_typed(_slim(obj))
+        if type_ != "msgpack" or len(data) < self.compress_min_bytes:
+            return type_, data
+
+        if zstandard is not None:
+            codec, compressed = "zstd", self._zstd_compressor.compress(data)
+        else:
+            codec, compressed = "zlib", zlib.compress(data, ZLIB_LEVEL)
+        if len(compressed) >= len(data):
+            return type_, data
+        return f"{type_}+{codec}", compressed
+
+    def loads_typed(self, data):
+        decompressor = self._zstd_decompressor if zstandard is not None else None
+        return super().loads_typed(_decompress(data, decompressor))
+
+
+def _slim(obj):
+    """Returns obj with every LangChain message replaced by a slimmer copy."""
+    if isinstance(obj, BaseMessage):
+        return _slim_message(obj)
+    if isinstance(obj, dict):
+        return {key: _slim(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_slim(item) for item in obj]
+    if isinstance(obj, tuple) and not hasattr(obj, "_fields"):
+        return tuple(_slim(item) for item in obj)
+    return obj
+
+
+def _slim_message(message):
+    update = {}
+
+    if message.response_metadata:
+        update["response_metadata"] = {
+            key: message.response_metadata[key]
+            for key in KEPT_RESPONSE_METADATA
+            if key in message.response_metadata
+        }
+
+    additional_kwargs = dict(message.additional_kwargs)
+    # Raw OpenAI tool calls duplicate AIMessage.tool_calls
+    if isinstance(message, AIMessage) and message.tool_calls:
+        additional_kwargs.pop("tool_calls", None)
+    if additional_kwargs.get("refusal", "") is None:
+        additional_kwargs.pop("refusal")
+    if additional_kwargs != message.additional_kwargs:
+        update["additional_kwargs"] = additional_kwargs
+
+    # ToolNode dumps tool results with spaced separators; same JSON, fewer bytes
+    if isinstance(message, ToolMessage) and isinstance(message.content, str):
+        try:
+            compact = json.dumps(
+                json.loads(message.content), ensure_ascii=False, separators=(",", ":")
+            )
+            if len(compact) < len(message.content):
+                update["content"] = compact
+        except ValueError:
+            pass
+
+    return message.model_copy(update=update) if update else message
+
+
+# ----------------------------------------------------------
+# Migration of existing checkpoint DBs
+# ----------------------------------------------------------
+def migrate_database(db_path, serde=None, batch_size=500):
+    """
+    Re-encodes every checkpoint and pending write of a SqliteSaver DB with the
+    compact format. Rows already in the compact format are re-encoded as well
+    (harmless). Run it while no graph is writing to this DB.
+
+    Returns (rows_migrated, bytes_before, bytes_after).
+    """
+    serde = serde or CompactSerializer()
+    conn = sqlite3.connect(db_path)
+    migrated = bytes_before = bytes_after = 0
+    try:
+        for table, column in (("checkpoints", "checkpoint"), ("writes", "value")):
+            last_rowid = 0
+            while True:
+                rows = conn.execute(
+                    f"SELECT rowid, type, {column} FROM {table} "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, batch_size),
+                ).fetchall()
+                if not rows:
+                    break
+                updates = []
+                for rowid, type_, payload in rows:
+                    if payload is None:
+                        continue
+                    new_type, new_payload = serde.dumps_typed(
+                        serde.loads_typed((type_, payload))
+                    )
+                    bytes_before += len(payload)
+                    bytes_after += len(new_payload)
+                    updates.append((new_type, new_payload, rowid))
+                conn.executemany(
+                    f"UPDATE {table} SET type = ?, {column} = ? WHERE rowid = ?",
+                    updates,
+                )
+                conn.commit()
+                migrated += len(updates)
+                last_rowid = rows[-1][0]
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return migrated, bytes_before, bytes_after
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "migrate":
+        print("Usage: python checkpoint_serde.py migrate <db_path> [<db_path> ...]")
+        sys.exit(1)
+    for path in sys.argv[2:]:
+        rows, before, after = migrate_database(path)
+        print(f"{path}: {rows} rows, {before:,} -> {after:,} bytes")
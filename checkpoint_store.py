@@ -0,0 +1,416 @@
+# checkpoint_store.py
+# Sharded SQLite checkpoint backend for running graphs from several threads and
+# worker processes at once, plus an in-memory cache of the latest checkpoint of
+# hot threads.
+#
+# Threads are spread across N SQLite files by a stable hash of thread_id. Every
+# file runs in WAL mode (readers don't block the writer) with a busy timeout.
+# Each process opens one connection per shard, shared by its threads behind
+# SqliteSaver's lock: graph steps and Streamlit reruns run on short-lived
+# threads, so per-thread connections would be reopened (pragmas, mmap, setup)
+# on every turn. Concurrency comes from the shards and from the processes.
+# Changing the number of shards remaps threads, so pick it once per deployment;
+# import_unsharded() moves the rows of an existing single-file DB into the
+# shards the first time a sharded store starts.
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    copy_checkpoint,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # Durable at WAL checkpoints; a power loss can only drop the last commits
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA cache_size=-16384",  # 16 MiB
+    "PRAGMA temp_store=MEMORY",
+)
+BUSY_TIMEOUT_SECONDS = 30
+# Rows copied per batch by import_unsharded()
+IMPORT_BATCH_ROWS = 500
+
+
+def shard_paths(directory, shards, basename="checkpoints"):
+    """data/graphs, 4 -> [data/graphs/checkpoints-0.db, ..., checkpoints-3.db]"""
+    return [os.path.join(directory, f"{basename}-{i}.db") for i in range(shards)]
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ShardedSqliteSaver(BaseCheckpointSaver):
+    """
+    Checkpointer that routes each thread_id to one of several SqliteSaver shards.
+
+    Args:
+        paths: One SQLite file per shard. A single path gives an unsharded store
+            that still gets WAL and the pragmas.
+        serde: Serializer shared by every shard.
+    """
+
+    def __init__(self, paths, *, serde=None):
+        super().__init__(serde=serde)
+        self.paths = list(paths)
+        self._savers = {}
+        self._savers_lock = threading.Lock()
+
+    # ------------------------------------------------------
+    # Routing
+    # ------------------------------------------------------
+    def shard_index(self, thread_id):
+        digest = hashlib.blake2b(str(thread_id).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % len(self.paths)
+
+    def _saver(self, index):
+        """The process's SqliteSaver for a shard, opened on first use."""
+        saver = self._savers.get(index)
+        if saver is None:
+            with self._savers_lock:
+                saver = self._savers.get(index)
+                if saver is None:
+                    saver = self._savers[index] = SqliteSaver(
+                        connect(self.paths[index]), serde=self.serde
+                    )
+        return saver
+
+    def _saver_for(self, config):
+        return self._saver(self.shard_index(config["configurable"]["thread_id"]))
+
+    # ------------------------------------------------------
+    # BaseCheckpointSaver
+    # ------------------------------------------------------
+    def get_tuple(self, config):
+        return self._saver_for(config).get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        if config is not None and "thread_id" in config.get("configurable", {}):
+            yield from self._saver_for(config).list(
+                config, filter=filter, before=before, limit=limit
+            )
+            return
+
+        # No thread given: walk every shard
+        remaining = limit
+        for index in range(len(self.paths)):
+            for checkpoint_tuple in self._saver(index).list(
+                config, filter=filter, before=before, limit=remaining
+            ):
+                yield checkpoint_tuple
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        return self._saver_for(config).put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        return self._saver_for(config).put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id):
+        self._saver(self.shard_index(thread_id)).delete_thread(thread_id)
+
+    def checkpoint_version(self, config):
+        """
+        (checkpoint_id, pending write count) of the checkpoint get_tuple(config)
+        would return, or None. Reads two indexed keys, no blobs.
+        """
+        configurable = config["configurable"]
+        query = (
+            "SELECT c.checkpoint_id, (SELECT COUNT(*) FROM writes w"
+            " WHERE w.thread_id = c.thread_id AND w.checkpoint_ns = c.checkpoint_ns"
+            " AND w.checkpoint_id = c.checkpoint_id)"
+            " FROM checkpoints c WHERE c.thread_id = ? AND c.checkpoint_ns = ?"
+        )
+        params = [str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")]
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND c.checkpoint_id = ?"
+            params.append(checkpoint_id)
+        else:
+            query += " ORDER BY c.checkpoint_id DESC LIMIT 1"
+        with self._saver_for(config).cursor(transaction=False) as cur:
+            row = cur.execute(query, params).fetchone()
+        return tuple(row) if row else None
+
+    def get_next_version(self, current, channel):
+        # SqliteSaver uses string versions; keep them so existing DBs stay valid
+        return self._saver(0).get_next_version(current, channel)
+
+    def import_unsharded(self, path):
+        """
+        Copies the checkpoints and writes of a single-file store into the shards
+        (rows as stored, no deserialization), then renames it to
+        `<path>.imported` so it runs once. Stop every worker still using the
+        single file first. Rows already present are kept, so a run interrupted
+        or repeated by another process starting at the same time is harmless.
+        Returns the number of rows copied.
+        """
+        if not os.path.exists(path) or path in self.paths:
+            return 0
+        try:
+            # mode=rw: never create an empty file if it was just renamed
+            source = sqlite3.connect(
+                f"file:{os.path.abspath(path)}?mode=rw",
+                uri=True,
+                timeout=BUSY_TIMEOUT_SECONDS,
+            )
+        except sqlite3.OperationalError:
+            return 0  # Imported by another process meanwhile
+        copied = 0
+        try:
+            # Fold the WAL into the main file, which is the one renamed below
+            source.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            for table in ("checkpoints", "writes"):
+                exists = source.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    (table,),
+                ).fetchone()
+                if exists:
+                    copied += self._import_table(source, table)
+            source.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            source.close()
+        try:
+            os.replace(path, path + ".imported")
+        except FileNotFoundError:
+            pass  # Another process finished the import first
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        return copied
+
+    def _import_table(self, source, table):
+        with self._saver(0).cursor() as cur:  # Creates the shard schema
+            target_columns = [
+                row[1] for row in cur.execute(f"PRAGMA table_info({table})")
+            ]
+        columns = [
+            row[1]
+            for row in source.execute(f"PRAGMA table_info({table})")
+            if row[1] in target_columns
+        ]
+        thread_column = columns.index("thread_id")
+        insert = (
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})"
+        )
+        rows = source.execute(f"SELECT {', '.join(columns)} FROM {table}")
+        copied = 0
+        while batch := rows.fetchmany(IMPORT_BATCH_ROWS):
+            by_shard = {}
+            for row in batch:
+                shard = self.shard_index(row[thread_column])
+                by_shard.setdefault(shard, []).append(row)
+            for index, shard_rows in by_shard.items():
+                with self._saver(index).cursor() as cur:
+                    cur.executemany(insert, shard_rows)
+            copied += len(batch)
+        return copied
+
+
+class CachedCheckpointSaver(BaseCheckpointSaver):
+    """
+    Read-through LRU cache of the latest checkpoint per thread, write-through to
+    the wrapped saver.
+
+    Active conversations are few and are read at the start of every turn, so their
+    latest checkpoint is served from memory without loading and deserializing the
+    blob. The cache is bounded by an estimate of the bytes it holds.
+
+    Other processes (messenger workers, Streamlit) may write the same thread, so
+    when the wrapped saver has checkpoint_version() every hit is first checked
+    against the checkpoint id and pending write count in the database; a cached
+    checkpoint that is no longer the latest is reloaded instead of served.
+
+    Args:
+        saver: The persistent checkpointer to wrap.
+        max_bytes: Approximate memory budget for cached checkpoints.
+        ttl: Seconds a cached checkpoint is trusted (None = until replaced).
+        validate: Check hits against the database (only safe to turn off when
+            each thread is written by a single process).
+    """
+
+    def __init__(self, saver, max_bytes=64 * 1024 * 1024, ttl=None, validate=True):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.validate = validate and hasattr(saver, "checkpoint_version")
+
+        self._lock = threading.Lock()
+        # (thread_id, checkpoint_ns) -> (CheckpointTuple, size, cached_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evictions = 0
+
+    # ------------------------------------------------------
+    # Cache helpers
+    # ------------------------------------------------------
+    @staticmethod
+    def _key(config):
+        configurable = config["configurable"]
+        return str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+
+    def _lookup(self, config):
+        key = self._key(config)
+        with self._lock:
+            entry = self._entries.get(key)
+        checkpoint_tuple = None
+        if entry is not None:
+            cached, _, cached_at = entry
+            cached_id = cached.config["configurable"]["checkpoint_id"]
+            fresh = self.ttl is None or time.monotonic() - cached_at < self.ttl
+            if fresh and get_checkpoint_id(config) in (None, cached_id):
+                checkpoint_tuple = cached
+        stale = False
+        if checkpoint_tuple is not None and self.validate:
+            # Another process may have written a newer checkpoint of the thread
+            version = (cached_id, len(checkpoint_tuple.pending_writes or []))
+            if self.saver.checkpoint_version(config) != version:
+                checkpoint_tuple, stale = None, True
+
+        with self._lock:
+            if checkpoint_tuple is not None:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self._hits += 1
+            else:
+                self._misses += 1
+                if stale:
+                    self._stale += 1
+                    if self._entries.get(key) is entry:
+                        self._discard(key)
+        return checkpoint_tuple
+
+    def _store(self, key, checkpoint_tuple):
+        size = _estimate_size(checkpoint_tuple.checkpoint["channel_values"])
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (checkpoint_tuple, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    @staticmethod
+    def _copy(checkpoint_tuple):
+        # Callers may mutate the checkpoint dicts; the cached one must stay intact
+        return checkpoint_tuple._replace(
+            checkpoint=copy_checkpoint(checkpoint_tuple.checkpoint),
+            pending_writes=list(checkpoint_tuple.pending_writes or []),
+        )
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "stale": self._stale,
+                "evictions": self._evictions,
+            }
+
+    def largest_threads(self, top=10):
+        """[(thread_id, estimated bytes)] of the biggest cached conversations."""
+        with self._lock:
+            sizes = [(key[0], entry[1]) for key, entry in self._entries.items()]
+        return sorted(sizes, key=lambda item: item[1], reverse=True)[:top]
+
+    # ------------------------------------------------------
+    # BaseCheckpointSaver
+    # ------------------------------------------------------
+    def get_tuple(self, config):
+        cached = self._lookup(config)
+        if cached is not None:
+            return self._copy(cached)
+
+        checkpoint_tuple = self.saver.get_tuple(config)
+        if checkpoint_tuple is not None and get_checkpoint_id(config) is None:
+            # Only the latest checkpoint of a thread is worth keeping
+            self._store(self._key(config), self._copy(checkpoint_tuple))
+        return checkpoint_tuple
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = self.saver.put(config, checkpoint, metadata, new_versions)
+        parent_config = config if get_checkpoint_id(config) else None
+        self._store(
+            self._key(next_config),
+            CheckpointTuple(
+                config=next_config,
+                checkpoint=copy_checkpoint(checkpoint),
+                metadata=get_checkpoint_metadata(config, metadata),
+                parent_config=parent_config,
+                pending_writes=[],
+            ),
+        )
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        self.saver.put_writes(config, writes, task_id, task_path)
+        # Pending writes follow the saver's own replace/ignore rules, so reload
+        # this checkpoint from the saver next time. The next put() re-caches it.
+        with self._lock:
+            self._discard(self._key(config))
+
+    def delete_thread(self, thread_id):
+        self.saver.delete_thread(thread_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == str(thread_id)]:
+                self._discard(key)
+
+    def get_next_version(self, current, channel):
+        return self.saver.get_next_version(current, channel)
+
+
+def _estimate_size(obj, _depth=0):
+    """Cheap recursive estimate of the memory held by checkpoint channel values."""
+    if isinstance(obj, (str, bytes)):
+        return 49 + len(obj)
+    if isinstance(obj, dict):
+        return 64 + sum(
+            _estimate_size(k, _depth + 1) + _estimate_size(v, _depth + 1)
+            for k, v in obj.items()
+        )
+    if isinstance(obj, (list, tuple, set)):
+        return 56 + sum(_estimate_size(item, _depth + 1) for item in obj)
+    if hasattr(obj, "__dict__") and _depth < 8:
+        # LangChain messages and other pydantic objects
+        return 64 + _estimate_size(vars(obj), _depth + 1)
+    return 32
@@ -0,0 +1,247 @@
+# connection_pools.py
+# Shared keep-alive HTTP connection pools for the external APIs.
+#
+# Every client of the same service (OpenAI, Groq, Airtable, Google Sheets, Meta)
+# goes through one pool per process, so a request reuses an open TLS connection
+# instead of paying DNS + TCP + TLS again. For requests-based clients the pool
+# is one HTTPAdapter per service, mounted on every session of that service,
+# including the ones built by client libraries (pyairtable, gspread). Pool sizes
+# are set per service. Connections idle for longer than the servers keep them
+# open are dropped before the next request instead of failing on it. prewarm()
+# opens the connections at worker start (AUTOFLUJO_PREWARM=1), and pool_stats()
+# reports how often a request found a connection to reuse.
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept open per service (≈ concurrent requests expected)
+POOL_SIZES = {
+    "openai": 20,
+    "groq": 10,
+    "airtable": 10,
+    "sheets": 4,
+    "meta": 10,
+}
+DEFAULT_POOL_SIZE = 4
+# Idle time after which a kept-alive connection is treated as closed by the
+# server (load balancers in front of these APIs drop idle ones after ~60 s)
+IDLE_SECONDS = float(os.getenv("AUTOFLUJO_POOL_IDLE_SECONDS", "50"))
+PREWARM = os.getenv("AUTOFLUJO_PREWARM", "0") == "1"
+
+# Cheap URLs that open a connection (the status code doesn't matter)
+PREWARM_URLS = {
+    "openai": "https://api.openai.com/v1/models",
+    "groq": "https://api.groq.com/openai/v1/models",
+    "airtable": "https://api.airtable.com/v0/meta/whoami",
+    "sheets": "https://sheets.googleapis.com/$discovery/rest?version=v4",
+}
+
+
+class PoolStats:
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.idle_refreshes = 0
+        self.last_used = None
+
+    def on_request(self):
+        """Counts a request; True when the pool sat idle long enough to refresh."""
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            idle = self.last_used is not None and now - self.last_used > IDLE_SECONDS
+            self.last_used = now
+            if idle:
+                self.idle_refreshes += 1
+            return idle
+
+    def on_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "pool_size": self.pool_size,
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reuse_ratio": (
+                    round(reused / self.requests, 3) if self.requests else None
+                ),
+                "idle_refreshes": self.idle_refreshes,
+            }
+
+
+_stats = {}
+_adapters = {}
+_sessions = {}
+_http_clients = {}
+_lock = threading.Lock()
+
+
+def _stats_for(name):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = PoolStats(POOL_SIZES.get(name, DEFAULT_POOL_SIZE))
+    return stats
+
+
+# ----------------------------------------------------------
+# requests (Airtable, gspread, Meta Graph API)
+# ----------------------------------------------------------
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that counts reuse and drops connections left idle too long."""
+
+    def __init__(self, stats, max_retries=0):
+        self.stats = stats
+        super().__init__(
+            pool_connections=4,
+            pool_maxsize=stats.pool_size,
+            max_retries=max_retries,
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+
+        # Pool classes that count every connection they open
+        def counting(pool_cls):
+            class CountingPool(pool_cls):
+                def _new_conn(self):
+                    stats.on_connection()
+                    return super()._new_conn()
+
+            return CountingPool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, request, **kwargs):
+        if self.stats.on_request():
+            self.poolmanager.clear()
+        return super().send(request, **kwargs)
+
+
+def _adapter_for(name, max_retries=0):
+    """The service's one PooledAdapter, created on first use."""
+    adapter = _adapters.get(name)
+    if adapter is None:
+        adapter = _adapters[name] = PooledAdapter(
+            _stats_for(name), max_retries=max_retries
+        )
+    return adapter
+
+
+def adopt_session(name, session, max_retries=None):
+    """
+    Mounts the service's pool on a session built by a client library (keeps its
+    auth headers) and returns it. Every session of a service shares the same
+    adapter, so connections opened by one (or by prewarm) serve the others; the
+    adopted session's retry policy becomes the adapter's.
+    """
+    if max_retries is None:
+        max_retries = session.get_adapter("https://").max_retries
+    with _lock:
+        adapter = _adapter_for(name)
+        adapter.max_retries = Retry.from_int(max_retries)
+        _sessions.setdefault(name, session)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(name, max_retries=0):
+    """Process-wide requests.Session of the service."""
+    with _lock:
+        session = _sessions.get(name)
+    if session is None:
+        session = adopt_session(name, requests.Session(), max_retries=max_retries)
+    return session
+
+
+# ----------------------------------------------------------
+# httpx (OpenAI and Groq SDKs)
+# ----------------------------------------------------------
+def get_http_client(name):
+    """Process-wide httpx.Client of the service, for the SDKs' http_client option."""
+    import httpx
+
+    with _lock:
+        client = _http_clients.get(name)
+        if client is not None:
+            return client
+        stats = _stats_for(name)
+
+        def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                stats.on_connection()
+
+        def on_request(request):
+            stats.on_request()
+            request.extensions["trace"] = trace
+
+        client = _http_clients[name] = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=stats.pool_size,
+                max_keepalive_connections=stats.pool_size,
+                keepalive_expiry=IDLE_SECONDS,
+            ),
+            follow_redirects=True,
+            event_hooks={"request": [on_request]},
+        )
+        return client
+
+
+# ----------------------------------------------------------
+# Pre-warming and metrics
+# ----------------------------------------------------------
+def prewarm(names=None, timeout=5):
+    """
+    Opens one connection per service in the background, in the same pools the
+    clients use. requests-based services are warmed through their shared
+    adapter, so sessions adopted later (pyairtable, gspread) find the
+    connection open.
+    """
+    names = names or list(PREWARM_URLS)
+
+    def warm(name):
+        url = PREWARM_URLS[name]
+        try:
+            if name in ("openai", "groq"):
+                get_http_client(name).head(url, timeout=timeout)
+            else:
+                with _lock:
+                    adapter = _adapter_for(name)
+                # Not closed: closing a session closes its adapters
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.head(url, timeout=timeout)
+        except Exception as e:
+            print(f"Pre-warm of {name} failed: {e}")
+
+    threads = [
+        threading.Thread(target=warm, args=(name,), name=f"prewarm-{name}", daemon=True)
+        for name in names
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def prewarm_on_start():
+    """prewarm() when AUTOFLUJO_PREWARM=1; called once per worker."""
+    if PREWARM:
+        prewarm()
+
+
+def pool_stats():
+    with _lock:
+        return {name: stats.snapshot() for name, stats in _stats.items()}
@@ -0,0 +1,271 @@
+# deadlines.py
+# Per-turn latency budget and circuit breakers for external dependencies.
+#
+# Each turn gets an absolute deadline in config["configurable"]["__deadline"]
+# (see with_deadline), readable from any node or tool through ensure_config().
+# The "__" prefix keeps it out of the checkpoint metadata. Calls to OpenAI,
+# Airtable, etc. go through guarded_call(), which gives them a timeout derived
+# from the time left and fails fast while the dependency's circuit breaker is
+# open. Only timeouts, connection errors and 5xx/429 responses count against a
+# breaker. Optional nodes check has_time_for() and are skipped when the budget
+# runs short; they catch up on a later turn.
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
+
+from langchain_core.runnables import ensure_config
+
+# Seconds from the user's message to the reply
+TURN_BUDGET_SECONDS = float(os.getenv("AUTOFLUJO_TURN_BUDGET", "20"))
+# Kept free at the end of the turn to build and send the reply
+REPLY_RESERVE_SECONDS = 1.0
+# Upper bound of a single call, whatever the budget left
+MAX_CALL_SECONDS = {"llm": 15.0, "airtable": 5.0}
+# Time left required to run the optional nodes
+OPTIONAL_NODE_SECONDS = {"extract_data": 6.0, "summarize_conversation": 8.0}
+
+BREAKER_FAILURE_THRESHOLD = 5  # Consecutive failures that open the circuit
+BREAKER_RESET_SECONDS = 30.0  # Open time before one trial call is let through
+
+DEADLINE_KEY = "__deadline"
+
+# Runs guarded calls so they can be abandoned at their timeout. Calls from every
+# turn worker (messenger and Streamlit) share it, and abandoned calls hold their
+# thread until the client-side timeout ends them, so keep it well above the
+# number of turn workers.
+GUARDED_CALL_WORKERS = int(os.getenv("AUTOFLUJO_GUARDED_CALL_WORKERS", "128"))
+_executor = ThreadPoolExecutor(
+    max_workers=GUARDED_CALL_WORKERS, thread_name_prefix="guarded-call"
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; after
+    `reset_seconds` one trial call is allowed (half-open) and its outcome closes
+    or reopens the circuit.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=BREAKER_FAILURE_THRESHOLD,
+        reset_seconds=BREAKER_RESET_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def release_trial(self):
+        """Ends a half-open trial that didn't reach the dependency."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_running:
+                    print(f"Circuit for {self.name} opened.")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "rejected": self.rejected,
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(dependency):
+    with _breakers_lock:
+        breaker = _breakers.get(dependency)
+        if breaker is None:
+            breaker = _breakers[dependency] = CircuitBreaker(dependency)
+        return breaker
+
+
+def dependency_health():
+    with _breakers_lock:
+        return {name: breaker.snapshot() for name, breaker in _breakers.items()}
+
+
+# ----------------------------------------------------------
+# Deadline
+# ----------------------------------------------------------
+def with_deadline(config, budget=TURN_BUDGET_SECONDS):
+    """Returns the turn's config with an absolute deadline (kept if already set)."""
+    configurable = dict(config.get("configurable", {}))
+    configurable.setdefault(DEADLINE_KEY, time.time() + budget)
+    return {**config, "configurable": configurable}
+
+
+def remaining():
+    """Seconds left in the current turn (None outside a turn with a deadline)."""
+    deadline = ensure_config().get("configurable", {}).get(DEADLINE_KEY)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def has_time_for(node):
+    """False when the optional node would not fit in the time left."""
+    left = remaining()
+    return left is None or left - REPLY_RESERVE_SECONDS >= OPTIONAL_NODE_SECONDS[node]
+
+
+def call_timeout(dependency):
+    cap = MAX_CALL_SECONDS.get(dependency, 10.0)
+    left = remaining()
+    if left is None:
+        return cap
+    return min(cap, left - REPLY_RESERVE_SECONDS)
+
+
+@lru_cache(maxsize=1)
+def _transient_errors():
+    """Exception types meaning the dependency couldn't be reached in time."""
+    errors = [ConnectionError, TimeoutError]
+    try:
+        import requests
+
+        errors += [requests.ConnectionError, requests.Timeout]
+    except ImportError:
+        pass
+    try:
+        import httpx
+
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        import openai
+
+        errors.append(openai.APIConnectionError)  # Includes APITimeoutError
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def is_transient(error):
+    """
+    True for failures that say the dependency is down or overloaded (timeouts,
+    connection errors, 5xx and 429). A 400 or a validation error is the
+    caller's fault and must not open the circuit.
+    """
+    if isinstance(error, _transient_errors()):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+def guarded_call(dependency, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) with a timeout from the turn budget and the
+    dependency's circuit breaker. Raises DeadlineExceeded or CircuitOpenError
+    instead of waiting.
+
+    The call's timeout counts from when it starts running: time spent waiting
+    for a free executor thread only uses up the turn budget and is never held
+    against the dependency.
+    """
+    breaker = get_breaker(dependency)
+    timeout = call_timeout(dependency)
+    if timeout <= 0:
+        raise DeadlineExceeded(f"No time left for {dependency}.")
+    if not breaker.allow():
+        raise CircuitOpenError(f"{dependency} is unavailable (circuit open).")
+
+    started = threading.Event()
+    started_at = []
+    # Run in the caller's context so callbacks, config and deadline still apply
+    context = contextvars.copy_context()
+
+    def run():
+        started_at.append(time.monotonic())
+        started.set()
+        return context.run(fn, *args, **kwargs)
+
+    submitted_at = time.monotonic()
+    future = _executor.submit(run)
+    left = remaining()
+    queue_limit = timeout if left is None else left - REPLY_RESERVE_SECONDS
+    if not started.wait(max(0.0, queue_limit)) and future.cancel():
+        # Never started: the process is busy, not the dependency
+        breaker.release_trial()
+        raise DeadlineExceeded(
+            f"No worker free for {dependency} within the turn budget."
+        )
+    started.wait()
+    # The call's own clock starts when it runs, capped by the turn time left
+    call_left = timeout - (time.monotonic() - started_at[0])
+    if left is not None:
+        turn_left = left - REPLY_RESERVE_SECONDS - (time.monotonic() - submitted_at)
+        call_left = min(call_left, turn_left)
+    try:
+        result = future.result(timeout=max(0.0, call_left))
+    except FutureTimeoutError:
+        if time.monotonic() - started_at[0] >= timeout:
+            breaker.record_failure()
+        else:
+            # Cut short by the turn budget, not slow by the dependency's bound
+            breaker.release_trial()
+        raise DeadlineExceeded(f"{dependency} took more than {timeout:.1f}s.")
+    except Exception as e:
+        if is_transient(e):
+            breaker.record_failure()
+        else:
+            # The dependency answered; the request itself was wrong
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
@@ -0,0 +1,332 @@
+# email_queue.py
+# Background SendGrid dispatch with a persistent client, retries and a local outbox.
+#
+# Every job is written to an SQLite outbox ("pending") before it is queued.
+# Streamlit and the messenger workers share the outbox, so a job is claimed
+# ("sending", with an owner and a claim time) in one UPDATE right before each
+# attempt; a process that loses the race skips the job. After the attempt it is
+# marked "sent"/"failed", or goes back to "pending" with the time of its next
+# retry. Each worker also sweeps the outbox for pending jobs nobody picked up
+# (their process stopped or is backlogged) and for claims of dead processes.
+import json
+import os
+import queue
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+
+from emails_templates import asunto_1, mensaje_1_html, mensaje_1_plain
+
+load_dotenv()
+
+FROM_EMAIL = "Alex de AutoFlujo Star <alex@autoflujo.com>"
+OUTBOX_DB_PATH = "data/crm/email_outbox.db"
+
+# SendGrid accepts up to 1000 personalizations per request
+CAMPAIGN_BATCH_SIZE = 500
+# A job claimed this long ago without finishing belongs to a dead process
+# (a single SendGrid request takes seconds)
+CLAIM_TIMEOUT_SECONDS = 900
+# How often a worker sweeps the outbox; also how late a pending job may be
+# before another process picks it up
+SWEEP_SECONDS = 300
+# Finished jobs are kept this long, then deleted on start
+RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class EmailDispatcher:
+    def __init__(
+        self,
+        api_key,
+        outbox_path=OUTBOX_DB_PATH,
+        max_attempts=5,
+        base_delay=2.0,
+        max_delay=300.0,
+    ):
+        self.client = SendGridAPIClient(api_key)
+        self.outbox_path = outbox_path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Identifies this process's claims in the shared outbox
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._queue = queue.Queue()
+        self._outbox_lock = threading.Lock()
+        self._conn = None
+        # Job ids queued or waiting for a retry in this process
+        self._queued = set()
+        self._pending_cond = threading.Condition()
+        self._swept_at = 0.0
+        self._worker = None
+
+    # ------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------
+    def start(self):
+        """Opens the outbox, picks up unsent jobs and starts the worker (idempotent)."""
+        if self._worker is not None:
+            return self
+        self._open_outbox()
+        self._sweep()
+        self._worker = threading.Thread(
+            target=self._run, name="email-dispatcher", daemon=True
+        )
+        self._worker.start()
+        return self
+
+    def enqueue(self, recipient, subject, html_content, plain_text=None):
+        """Queues one email and returns its job id without waiting for SendGrid."""
+        return self._submit(
+            self._new_job([recipient], subject, html_content, plain_text)
+        )
+
+    def enqueue_campaign(
+        self,
+        recipients,
+        subject,
+        html_content,
+        plain_text=None,
+        batch_size=CAMPAIGN_BATCH_SIZE,
+    ):
+        """
+        Queues the same email for many recipients, one SendGrid request per batch.
+        Each recipient gets an individual copy (they don't see each other).
+        """
+        recipients = [r.strip() for r in recipients if r and r.strip()]
+        return [
+            self._submit(
+                self._new_job(
+                    recipients[i : i + batch_size], subject, html_content, plain_text
+                )
+            )
+            for i in range(0, len(recipients), batch_size)
+        ]
+
+    def wait_until_empty(self, timeout=None):
+        """Blocks until every queued job was sent or gave up. Returns False on timeout."""
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: not self._queued, timeout)
+
+    # ------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------
+    def _run(self):
+        while True:
+            if time.monotonic() - self._swept_at > SWEEP_SECONDS:
+                self._sweep()
+            try:
+                job_id = self._queue.get(timeout=SWEEP_SECONDS)
+            except queue.Empty:
+                continue
+            try:
+                self._process(job_id)
+            except sqlite3.Error as e:
+                # The job stays in the outbox and a later sweep picks it up
+                print(f"Outbox error on email job {job_id}: {e}")
+                self._done(job_id)
+            finally:
+                self._queue.task_done()
+
+    def _sweep(self):
+        self._swept_at = time.monotonic()
+        try:
+            job_ids = self._unclaimed_jobs()
+        except sqlite3.Error as e:
+            print(f"Error sweeping the email outbox: {e}")
+            return
+        with self._pending_cond:
+            job_ids = [job_id for job_id in job_ids if job_id not in self._queued]
+        for job_id in job_ids:
+            self._enqueue_job(job_id)
+        if job_ids:
+            print(f"Picked up {len(job_ids)} pending email job(s) from the outbox.")
+
+    def _process(self, job_id):
+        job = self._claim(job_id)
+        if job is None:
+            # Finished, or another process is sending it
+            self._done(job_id)
+            return
+        try:
+            response = self.client.send(self._build_message(job))
+            print(
+                f"Email sent to {len(job['to'])} recipient(s)! "
+                f"Status Code: {response.status_code}"
+            )
+            self._finish(job_id, "sent")
+            return
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            print(f"Error sending email job {job_id}: {status or ''} {e}")
+            # 4xx errors other than rate limiting won't succeed on retry
+            retryable = status is None or status == 429 or status >= 500
+
+        if retryable and job["attempts"] < self.max_attempts:
+            delay = min(self.base_delay * 2 ** (job["attempts"] - 1), self.max_delay)
+            self._release(job_id, time.time() + delay)
+            timer = threading.Timer(delay, self._queue.put, args=(job_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._finish(job_id, "failed")
+
+    def _done(self, job_id):
+        with self._pending_cond:
+            self._queued.discard(job_id)
+            self._pending_cond.notify_all()
+
+    # ------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------
+    def _new_job(self, recipients, subject, html_content, plain_text):
+        return {
+            "id": uuid.uuid4().hex,
+            "to": list(recipients),
+            "subject": subject,
+            "html": html_content,
+            "plain": plain_text,
+        }
+
+    def _submit(self, job):
+        # Raises when the outbox can't be written: the job was not queued
+        with self._outbox_lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO outbox (id, job, status, attempts, next_attempt_at)"
+                " VALUES (?, ?, 'pending', 0, ?)",
+                (job["id"], json.dumps(job, ensure_ascii=False), time.time()),
+            )
+        self._enqueue_job(job["id"])
+        return job["id"]
+
+    def _enqueue_job(self, job_id):
+        with self._pending_cond:
+            self._queued.add(job_id)
+        self._queue.put(job_id)
+
+    def _build_message(self, job):
+        message = Mail(
+            from_email=FROM_EMAIL,
+            to_emails=job["to"] if len(job["to"]) > 1 else job["to"][0],
+            subject=job["subject"],
+            html_content=job["html"],
+            is_multiple=len(job["to"]) > 1,
+        )
+        if job["plain"]:
+            message.plain_text_content = job["plain"]
+        return message
+
+    # ------------------------------------------------------
+    # Outbox
+    # ------------------------------------------------------
+    def _open_outbox(self):
+        os.makedirs(os.path.dirname(self.outbox_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.outbox_path, timeout=30, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                job TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                next_attempt_at REAL,
+                owner TEXT,
+                claimed_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_status
+                ON outbox (status, next_attempt_at);
+            """)
+        with self._outbox_lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'failed')"
+                " AND finished_at < ?",
+                (time.time() - RETENTION_SECONDS,),
+            )
+
+    def _claim(self, job_id):
+        """
+        Takes the job for one attempt. Returns it with its attempt count, or
+        None when it is finished or claimed by a live process.
+        """
+        now = time.time()
+        with self._outbox_lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET status = 'sending', owner = ?, claimed_at = ?,"
+                " attempts = attempts + 1"
+                " WHERE id = ? AND (status = 'pending'"
+                " OR (status = 'sending' AND claimed_at < ?))",
+                (self.owner, now, job_id, now - CLAIM_TIMEOUT_SECONDS),
+            )
+            if cursor.rowcount != 1:
+                return None
+            job, attempts = self._conn.execute(
+                "SELECT job, attempts FROM outbox WHERE id = ?", (job_id,)
+            ).fetchone()
+        return {**json.loads(job), "attempts": attempts}
+
+    def _release(self, job_id, next_attempt_at):
+        """Puts a failed attempt back to pending until its retry time."""
+        with self._outbox_lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'pending', owner = NULL,"
+                " next_attempt_at = ? WHERE id = ? AND owner = ?",
+                (next_attempt_at, job_id, self.owner),
+            )
+
+    def _finish(self, job_id, status):
+        with self._outbox_lock, self._conn:
+            # Left "sending" if this fails: resent after the claim timeout
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, owner = NULL, finished_at = ?"
+                " WHERE id = ? AND owner = ?",
+                (status, time.time(), job_id, self.owner),
+            )
+        self._done(job_id)
+
+    def _unclaimed_jobs(self):
+        """Ids of jobs overdue by a sweep interval, or claimed by a dead process."""
+        now = time.time()
+        with self._outbox_lock:
+            rows = self._conn.execute(
+                "SELECT id FROM outbox"
+                " WHERE (status = 'pending' AND next_attempt_at < ?)"
+                " OR (status = 'sending' AND claimed_at < ?)",
+                (now - SWEEP_SECONDS, now - CLAIM_TIMEOUT_SECONDS),
+            ).fetchall()
+        return [job_id for (job_id,) in rows]
+
+
+@lru_cache(maxsize=None)
+def get_email_dispatcher():
+    """Process-wide dispatcher, started on first use."""
+    return EmailDispatcher(os.getenv("SENDGRID_API_KEY")).start()
+
+
+def enviar_campana_bienvenida(recipients, batch_size=CAMPAIGN_BATCH_SIZE):
+    """Queues the onboarding welcome email for a list of recipients."""
+    return get_email_dispatcher().enqueue_campaign(
+        recipients,
+        subject=asunto_1,
+        html_content=mensaje_1_html,
+        plain_text=mensaje_1_plain,
+        batch_size=batch_size,
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python email_queue.py recipients.txt  (one email per line)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        job_ids = enviar_campana_bienvenida(f.read().splitlines())
+    print(f"Queued {len(job_ids)} batch(es). Waiting for delivery...")
+    get_email_dispatcher().wait_until_empty()
@@ -0,0 +1,185 @@
+# faq_answers.py
+# Canonical answers to the questions the onboarding form already covers.
+#
+# The form collects a fixed set of fields (hours, address, delivery, payment,
+# promotions, pets, ...) and customers mostly ask about exactly those. When a
+# profile is published (tenant_registry.publish, called by mark_form_completed)
+# build_answers() writes one short answer per intent. At chat time
+# match_intent() recognizes those questions with keyword patterns, so they are
+# answered from the stored table without calling the LLM. Anything ambiguous
+# (several intents, reservation talk, long messages, a specific day or date)
+# goes to the graph as usual.
+import os
+import re
+import threading
+import unicodedata
+
+ENABLED = os.getenv("AUTOFLUJO_FAQ_ANSWERS", "1") == "1"
+# Longer messages usually carry more than one question or context
+MAX_QUESTION_CHARS = 120
+
+FOLLOW_UP = "¿Te puedo ayudar con algo más o quieres hacer una reservación?"
+
+# intent -> (profile key, patterns over the normalized text, answer template)
+INTENTS = {
+    "hours": (
+        "hours",
+        [r"\bhorario", r"\ba que hora (abren|cierran)", r"\b(abren|cierran)\b"],
+        "Nuestro horario es:\n{value}",
+    ),
+    "address": (
+        "address",
+        [r"\bdireccion\b", r"\bdonde (estan|se encuentran|queda)", r"\bubicacion\b"],
+        "Nos encuentras en: {value}",
+    ),
+    "menu": (
+        "menu_url",
+        [
+            r"\b(ver|pasar|pasas|mandar|mandas|enviar|link|liga|tienen) (el |un |su )?menu\b",
+            r"^\s*(el )?menu\s*$",
+            r"\bla carta\b",
+        ],
+        "Puedes ver nuestro menú aquí: {value}",
+    ),
+    "contact": (
+        "contact",
+        [r"\btelefono\b", r"\bwhatsapp\b", r"\bnumero de contacto\b"],
+        "Puedes contactarnos en: {value}",
+    ),
+    "delivery": (
+        "delivery",
+        [r"\bdomicilio\b", r"\bpara llevar\b", r"\bdelivery\b", r"\bpick ?up\b"],
+        "Sobre servicio para llevar o a domicilio: {value}",
+    ),
+    "payment": (
+        "payment",
+        [
+            r"\bmetodos? de pago\b",
+            r"\bformas? de pago\b",
+            r"\btarjeta",
+            r"\befectivo\b",
+            r"\btransferencia",
+        ],
+        "Aceptamos: {value}",
+    ),
+    "promotions": (
+        "promotions",
+        [r"\bpromocion", r"\bdescuento", r"\bpaquetes?\b", r"\bofertas?\b"],
+        "Nuestras promociones: {value}",
+    ),
+    "pets": (
+        "pets",
+        [r"\bmascota", r"\bperros?\b", r"\bgatos?\b", r"\bpet ?friendly\b"],
+        None,  # Yes/no field, see _pets_answer
+    ),
+}
+# Messages about bookings always go to the graph (it owns the reservation tools)
+RESERVATION_PATTERN = re.compile(
+    r"\b(reserva|reservar|reservacion|mesa|cancelar|cambiar|modificar|personas)"
+)
+# Questions only: answers given during the booking flow ("mi teléfono es ...")
+# must reach the graph
+QUESTION_PATTERN = re.compile(
+    r"^\s*(que|cual|cuales|donde|como|cuando|a que|tienen|aceptan|hay|puedo|"
+    r"se puede|abren|cierran|me (das|pasas|compartes))\b"
+)
+DIGITS_PATTERN = re.compile(r"\d{4,}")
+# Questions about a given day ("¿abren el 25 de diciembre?", "¿cierran temprano
+# hoy?") depend on holidays and special days the stored answer doesn't cover
+MONTHS = (
+    "enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|"
+    "octubre|noviembre|diciembre"
+)
+DATE_PATTERN = re.compile(
+    r"\b(hoy|manana|pasado manana|esta noche|ahorita|ahora|lunes|martes|"
+    r"miercoles|jueves|viernes|sabado|domingo|fin de semana|finde|"
+    r"festivos?|feriados?|puente|navidad|nochebuena|ano nuevo|semana santa|"
+    rf"temprano|tarde|{MONTHS})\b"
+    r"|\b\d{1,2} ?(/|-) ?\d{1,2}\b"
+)
+# Intents whose stored answer Información Adicional (holidays, special days,
+# temporary changes) may contradict
+EXTRA_INFO_INTENTS = {"hours"}
+_COMPILED = {
+    intent: [re.compile(pattern) for pattern in patterns]
+    for intent, (_, patterns, _) in INTENTS.items()
+}
+
+
+def normalize(text):
+    """Lowercase without accents or '¿?¡!' so patterns stay simple."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"[¿?¡!.,;:]", " ", text)
+
+
+def _pets_answer(value):
+    if normalize(value).strip().startswith("no"):
+        return "Lo sentimos, no se permite el ingreso con mascotas."
+    return "¡Sí! Las mascotas son bienvenidas."
+
+
+def build_answers(profile):
+    """Profile dict (see tenant_registry.parse_row) -> {intent: answer}."""
+    answers = {}
+    for intent, (key, _, template) in INTENTS.items():
+        value = (profile.get(key) or "").strip()
+        if not value:
+            continue
+        if intent == "pets":
+            answer = _pets_answer(value)
+        elif intent == "promotions" and normalize(value).strip() in ("no aplica", "no"):
+            answer = "Por el momento no tenemos promociones especiales."
+        else:
+            answer = template.format(value=value)
+        answers[intent] = f"{answer}\n\n{FOLLOW_UP}"
+    return answers
+
+
+def match_intent(text):
+    """The single FAQ intent of a short question, or None."""
+    if not text or len(text) > MAX_QUESTION_CHARS:
+        return None
+    normalized = normalize(text)
+    if (
+        RESERVATION_PATTERN.search(normalized)
+        or DIGITS_PATTERN.search(normalized)
+        or DATE_PATTERN.search(normalized)
+    ):
+        return None
+    if "?" not in text and not QUESTION_PATTERN.search(normalized):
+        return None
+    matched = [
+        intent
+        for intent, patterns in _COMPILED.items()
+        if any(pattern.search(normalized) for pattern in patterns)
+    ]
+    return matched[0] if len(matched) == 1 else None
+
+
+_stats = {"answered": 0}
+_stats_lock = threading.Lock()
+
+
+def answer_question(text, answers, profile=None):
+    """
+    Stored answer for the question, or None when the graph should answer.
+    With the profile, hours questions of restaurants that fill in Información
+    Adicional go to the graph, which reads that text.
+    """
+    if not ENABLED or not answers:
+        return None
+    intent = match_intent(text)
+    if intent in EXTRA_INFO_INTENTS and (profile or {}).get("extra_info"):
+        return None
+    answer = answers.get(intent) if intent else None
+    if answer is not None:
+        with _stats_lock:
+            _stats["answered"] += 1
+            _stats[intent] = _stats.get(intent, 0) + 1
+    return answer
+
+
+def faq_stats():
+    with _stats_lock:
+        return dict(_stats)
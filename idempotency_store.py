@@ -0,0 +1,173 @@
+# idempotency_store.py
+# SQLite store of idempotency keys shared by the reservation tools and the graph
+# entry points (reservation_idempotency.py, turn_idempotency.py).
+#
+# The first call with a key claims it and does the work; later calls with the
+# same key wait while it is still running and then get its stored result instead
+# of doing the work again. A failed call releases the key so a retry can run,
+# and a claim left by a crashed call is taken over after claim_timeout. Keys
+# may expire (ttl) and the table may be capped (max_entries).
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# How often a waiting duplicate checks whether the running call finished
+POLL_SECONDS = 0.25
+# Expired and excess keys are pruned every this many completed calls
+PRUNE_EVERY = 500
+
+
+class IdempotencyStore:
+    """
+    Args:
+        db_path: SQLite file of the store.
+        table: Table of the keys; counters go to "<table>_stats".
+        claim_timeout: Seconds after which an unfinished claim may be taken over.
+        wait_seconds: How long a duplicate waits for the running call.
+        busy_message: Message of the TimeoutError raised when the wait runs out.
+        ttl: Default seconds a key lives (None = until forgotten).
+        max_entries: Keys kept at most, oldest dropped first (None = no cap).
+    """
+
+    def __init__(
+        self,
+        db_path,
+        table,
+        claim_timeout,
+        wait_seconds,
+        busy_message,
+        ttl=None,
+        max_entries=None,
+    ):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.table = table
+        self.claim_timeout = claim_timeout
+        self.wait_seconds = wait_seconds
+        self.busy_message = busy_message
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                thread_id TEXT,
+                record_id TEXT,
+                result TEXT,
+                claimed_at REAL NOT NULL,
+                expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_{table}_record ON {table} (record_id);
+            CREATE INDEX IF NOT EXISTS idx_{table}_expires ON {table} (expires_at);
+            CREATE TABLE IF NOT EXISTS {table}_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """)
+        self._conn.commit()
+
+    def claim(self, key, thread_id="", ttl=None):
+        """
+        Tries to take the key.
+
+        Returns None when the caller owns the key and must do the work (then
+        call complete() or release()), or the result stored by the earlier call.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        deadline = time.time() + self.wait_seconds
+        while True:
+            with self._lock:
+                now = time.time()
+                # Expired keys and claims abandoned by a crashed call
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key = ? AND (expires_at < ? "
+                    "OR (result IS NULL AND claimed_at < ?))",
+                    (key, now, now - self.claim_timeout),
+                )
+                inserted = self._conn.execute(
+                    f"INSERT OR IGNORE INTO {self.table} "
+                    "(key, thread_id, claimed_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, thread_id, now, now + ttl if ttl is not None else None),
+                ).rowcount
+                self._conn.commit()
+                if inserted:
+                    return None
+
+                row = self._conn.execute(
+                    f"SELECT result FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[0] is not None:
+                    self._increment("suppressed_duplicates")
+                    return json.loads(row[0])
+
+            # The same call is running right now; wait for its result
+            if time.time() > deadline:
+                raise TimeoutError(self.busy_message)
+            time.sleep(POLL_SECONDS)
+
+    def complete(self, key, result, record_id=None):
+        """Stores the result of a claimed key (JSON-serializable)."""
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET result = ?, record_id = ? WHERE key = ?",
+                (json.dumps(result, ensure_ascii=False), record_id, key),
+            )
+            self._increment("completed")
+            self._completed += 1
+            if self._completed % PRUNE_EVERY == 0:
+                self._prune()
+            self._conn.commit()
+
+    def release(self, key):
+        """Drops a claim whose call failed so a retry can run it again."""
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key = ? AND result IS NULL", (key,)
+            )
+            self._conn.commit()
+
+    def forget_record(self, record_id):
+        """Drops the keys of a record that changed, so they no longer suppress calls."""
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE record_id = ?", (record_id,)
+            )
+            self._conn.commit()
+
+    def _prune(self):
+        """Removes expired keys, then the oldest ones above max_entries."""
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),)
+        )
+        if self.max_entries is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM "
+                f"{self.table} ORDER BY claimed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def _increment(self, name):
+        self._conn.execute(
+            f"INSERT INTO {self.table}_stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+        self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(
+                self._conn.execute(f"SELECT name, value FROM {self.table}_stats")
+            )
+            tracked = self._conn.execute(
+                f"SELECT COUNT(*) FROM {self.table} WHERE result IS NOT NULL"
+            ).fetchone()[0]
+        return {
+            "completed": counters.get("completed", 0),
+            "suppressed_duplicates": counters.get("suppressed_duplicates", 0),
+            "tracked_keys": tracked,
+        }
@@ -0,0 +1,157 @@
+# llm_cassette.py
+# Record/replay of LLM calls for development, tests and benchmarks.
+#
+# A cassette is a LangChain cache (BaseCache) plugged into the chat models built
+# by agents.get_llm(). Each response (text, tool calls and usage metadata) is
+# stored under a hash of the request: messages without ids, the "Hoy es ..."
+# timestamp of the prompts masked, and the model parameters including bound
+# tools. Entries are appended to one gzip-compressed JSON-lines file and held
+# in a dict, so replayed graph runs cost nothing and answer at memory speed.
+#
+# AUTOFLUJO_LLM_CASSETTE:
+#   passthrough  (default) no cassette, every call goes to the provider
+#   record       recorded requests are replayed, new ones are called and stored
+#   replay       recorded requests only; an unknown request raises CassetteMiss
+#
+# Only the LLM calls are recorded. The retriever tools still call the embeddings
+# API and Pinecone, and the reservation tools read Airtable live. In replay mode
+# the reservation tools refuse to write (see writes_allowed), so a replay never
+# creates or changes real bookings. A recorded run that booked a reservation
+# therefore replays up to that tool call only: the tool result differs (the
+# error here, and a new record id on every live run), so the next prompt misses.
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+MODE = os.getenv("AUTOFLUJO_LLM_CASSETTE", "passthrough")
+CASSETTE_PATH = os.getenv("AUTOFLUJO_LLM_CASSETTE_PATH", "data/cassettes/llm.jsonl.gz")
+MODES = ("passthrough", "record", "replay")
+
+# The prompts embed the current time; it must not change the request hash
+TIMESTAMP_PATTERN = re.compile(
+    r"Hoy es [^\n]{0,60}? a las \d{1,2}:\d{2} ?[AaPp]\.? ?[Mm]\.?"
+)
+
+
+class CassetteMiss(KeyError):
+    pass
+
+
+def _strip_ids(obj):
+    """Message ids are random per run; drop them from the serialized messages."""
+    if isinstance(obj, dict):
+        return {key: _strip_ids(value) for key, value in obj.items() if key != "id"}
+    if isinstance(obj, list):
+        return [_strip_ids(value) for value in obj]
+    return obj
+
+
+def request_key(prompt, llm_string):
+    """Stable hash of a request (prompt is LangChain's serialized message list)."""
+    try:
+        messages = json.loads(prompt)
+        # Keep the "id" path of the serialized classes, drop the message ids
+        for message in messages if isinstance(messages, list) else []:
+            if isinstance(message, dict) and "kwargs" in message:
+                message["kwargs"] = _strip_ids(message["kwargs"])
+        prompt = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    except ValueError:
+        pass
+    prompt = TIMESTAMP_PATTERN.sub("Hoy es <now>", prompt)
+    return hashlib.sha256(f"{prompt}\n{llm_string}".encode()).hexdigest()
+
+
+class LLMCassette(BaseCache):
+    """
+    Args:
+        path: gzip JSON-lines file, one {"key", "generations"} entry per line.
+        mode: "record" or "replay" (see the module header).
+    """
+
+    def __init__(self, path=CASSETTE_PATH, mode="replay"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            # Appends write one gzip member each; gzip reads them as one stream
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._entries[entry["key"]] = entry["generations"]
+
+    def lookup(self, prompt, llm_string):
+        key = request_key(prompt, llm_string)
+        with self._lock:
+            generations = self._entries.get(key)
+            if generations is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if generations is not None:
+            return [loads(generation) for generation in generations]
+        if self.mode == "replay":
+            raise CassetteMiss(
+                f"LLM request {key[:12]} is not in {self.path}; "
+                "record it with AUTOFLUJO_LLM_CASSETTE=record."
+            )
+        return None
+
+    def update(self, prompt, llm_string, return_val):
+        if self.mode != "record":
+            return
+        key = request_key(prompt, llm_string)
+        generations = [dumps(generation) for generation in return_val]
+        line = json.dumps({"key": key, "generations": generations}, ensure_ascii=False)
+        with self._lock:
+            self._entries[key] = generations
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._entries.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def writes_allowed():
+    """False while replaying: tools must not change external systems then."""
+    return MODE != "replay"
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_llm_cassette():
+    """The process cassette, or None in passthrough mode."""
+    global _cassette
+    if MODE not in MODES:
+        raise ValueError(f"AUTOFLUJO_LLM_CASSETTE must be one of {MODES}")
+    if MODE == "passthrough":
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = LLMCassette(CASSETTE_PATH, MODE)
+        return _cassette
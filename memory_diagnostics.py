@@ -0,0 +1,267 @@
+# memory_diagnostics.py
+# Memory diagnostics for the long-running Streamlit and messenger processes.
+#
+# A background thread samples RSS every SAMPLE_SECONDS (one /proc read). Every
+# TRACE_EVERY samples it runs tracemalloc for TRACE_WINDOW_SECONDS only and
+# keeps the allocation sites that grew the most during that window, together
+# with object counts per type (LangChain messages, checkpoints, API clients)
+# and the largest conversations held in memory. Tracing a short window now and
+# then keeps the cost low enough to leave on in production.
+#
+# The latest report is written to data/diagnostics/memory-<pid>.json and served
+# by messenger_server at /debug/memory. Print reports with:
+#   python memory_diagnostics.py [pid]
+import gc
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+from checkpoint_store import _estimate_size
+
+ENABLED = os.getenv("AUTOFLUJO_MEMORY_PROFILER", "1") == "1"
+SAMPLE_SECONDS = int(os.getenv("AUTOFLUJO_MEMORY_SAMPLE_SECONDS", "300"))
+# One tracemalloc window every TRACE_EVERY samples (every 30 min by default)
+TRACE_EVERY = 6
+TRACE_WINDOW_SECONDS = 30
+TRACE_FRAMES = 1
+TOP = 15
+# RSS samples kept for the trend (24 h at the default rate)
+MAX_SAMPLES = 288
+REPORT_DIR = "data/diagnostics"
+
+# Object categories reported separately: (module prefix, class names or None = any)
+TRACKED_TYPES = {
+    "messages": ("langchain_core.messages", None),
+    "checkpoints": ("langgraph.checkpoint", {"CheckpointTuple"}),
+    "clients": (
+        "",
+        {
+            "Client",
+            "Session",
+            "AuthorizedSession",
+            "ChatOpenAI",
+            "ChatGroq",
+            "Api",
+            "SendGridAPIClient",
+        },
+    ),
+}
+
+
+def rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is missing)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def object_counts(top=TOP):
+    """Live objects per type (gc-tracked ones), plus the tracked categories."""
+    counts = Counter(type(obj) for obj in gc.get_objects())
+    categories = {name: 0 for name in TRACKED_TYPES}
+    for cls, count in counts.items():
+        # Some C types expose __module__ as a descriptor instead of a string
+        cls_module = cls.__dict__.get("__module__", "")
+        if not isinstance(cls_module, str):
+            continue
+        for name, (module, class_names) in TRACKED_TYPES.items():
+            if cls_module.startswith(module) and (
+                class_names is None or cls.__name__ in class_names
+            ):
+                categories[name] += count
+    return {
+        "categories": categories,
+        "top_types": [
+            (f"{getattr(cls, '__module__', '?')}.{cls.__qualname__}", count)
+            for cls, count in counts.most_common(top)
+        ],
+    }
+
+
+def session_footprint(top=10):
+    """
+    Largest conversations held by this process: cached checkpoints per thread
+    and, inside Streamlit, session_state per browser session.
+    """
+    footprint = {}
+    graph_module = sys.modules.get("restaurant_graph")
+    if graph_module is not None:
+        saver = graph_module.get_checkpointer()
+        if hasattr(saver, "largest_threads"):
+            footprint["checkpoint_cache"] = saver.largest_threads(top)
+    try:
+        from streamlit.runtime import get_instance
+
+        # Not public API; reported only when available
+        sessions = get_instance()._session_mgr.list_active_sessions()
+        sizes = [
+            (
+                info.session.id,
+                _estimate_size(dict(info.session.session_state.filtered_state)),
+            )
+            for info in sessions
+        ]
+        footprint["streamlit_sessions"] = sorted(
+            sizes, key=lambda item: item[1], reverse=True
+        )[:top]
+    except Exception:
+        pass
+    return footprint
+
+
+class MemoryProfiler:
+    """
+    Args:
+        sample_seconds: Seconds between RSS samples.
+        trace_every: Samples between tracemalloc windows (0 disables tracing).
+        trace_window: Seconds each tracemalloc window lasts.
+    """
+
+    def __init__(
+        self,
+        sample_seconds=SAMPLE_SECONDS,
+        trace_every=TRACE_EVERY,
+        trace_window=TRACE_WINDOW_SECONDS,
+    ):
+        self.sample_seconds = sample_seconds
+        self.trace_every = trace_every
+        self.trace_window = trace_window
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=MAX_SAMPLES)  # (unix time, rss bytes)
+        self._growth = []
+        self._traced_at = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts the sampling thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="memory-profiler", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        samples = 0
+        while not self._stop.is_set():
+            self.sample()
+            samples += 1
+            if self.trace_every and samples % self.trace_every == 0:
+                self.trace_window_growth()
+                self.write_report()
+            self._stop.wait(self.sample_seconds)
+
+    def sample(self):
+        with self._lock:
+            self._samples.append((time.time(), rss_bytes()))
+
+    def trace_window_growth(self, top=TOP):
+        """Traces allocations for trace_window seconds; keeps the top growing sites."""
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(TRACE_FRAMES)
+        try:
+            before = tracemalloc.take_snapshot()
+            self._stop.wait(self.trace_window)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+        # Leave out the snapshots' own bookkeeping
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = after.filter_traces(filters).compare_to(
+            before.filter_traces(filters), "lineno"
+        )
+        growth = [
+            {
+                "site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "count_diff": stat.count_diff,
+            }
+            for stat in stats[:top]
+            if stat.size_diff > 0
+        ]
+        with self._lock:
+            self._growth = growth
+            self._traced_at = time.time()
+        return growth
+
+    def report(self, include_objects=True):
+        with self._lock:
+            samples = list(self._samples)
+            growth = list(self._growth)
+            traced_at = self._traced_at
+        rss = rss_bytes()
+        report = {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "rss_mb": round(rss / 1024**2, 1),
+            # Growth over the kept samples, to spot slow leaks at a glance
+            "rss_growth_mb": (
+                round((rss - samples[0][1]) / 1024**2, 1) if samples else 0.0
+            ),
+            "rss_trend_mb": [
+                (int(ts), round(value / 1024**2, 1)) for ts, value in samples[-12:]
+            ],
+            "growth_window": {"traced_at": traced_at, "top_sites": growth},
+        }
+        if include_objects:
+            report["objects"] = object_counts()
+            report["sessions"] = session_footprint()
+        return report
+
+    def write_report(self):
+        try:
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            path = os.path.join(REPORT_DIR, f"memory-{os.getpid()}.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, indent=2, default=str)
+            os.replace(path + ".tmp", path)
+        except Exception as e:  # Diagnostics must never break the process
+            print(f"Error writing memory report: {e}")
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_memory_profiler():
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = MemoryProfiler()
+        return _profiler
+
+
+def start_memory_profiler():
+    """Starts sampling when AUTOFLUJO_MEMORY_PROFILER=1 (default); once per worker."""
+    if ENABLED:
+        get_memory_profiler().start()
+
+
+if __name__ == "__main__":
+    pattern = f"memory-{sys.argv[1]}.json" if len(sys.argv) > 1 else "memory-*.json"
+    paths = sorted(glob.glob(os.path.join(REPORT_DIR, pattern)))
+    if not paths:
+        print(f"No memory reports in {REPORT_DIR}.")
+        sys.exit(1)
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            print(json.dumps(json.load(f), indent=2, ensure_ascii=False))
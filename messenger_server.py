@@ -0,0 +1,455 @@
+# messenger_server.py
+# ASGI webhook service for WhatsApp Cloud API / Messenger style payloads.
+#
+# The webhook checks Meta's signature, parses and enqueues, then acknowledges.
+# Graph turns run on a bounded thread pool (call_model_from_messenger is
+# blocking), one turn at a time per thread_id so replies keep the order of the
+# incoming messages, and bursts of messages from the same user are coalesced
+# into one turn. Replies go out through a pluggable OutboundSender.
+#
+# Run with:  uvicorn messenger_server:app --host 0.0.0.0 --port 8000
+import abc
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from connection_pools import get_session, pool_stats, prewarm_on_start
+from deadlines import dependency_health
+from memory_diagnostics import get_memory_profiler, start_memory_profiler
+from turn_idempotency import message_ids_key
+
+# Graph turns running at the same time in this process
+MAX_WORKERS = int(os.getenv("MESSENGER_MAX_WORKERS", "32"))
+# Queued (not yet processed) messages before the webhook starts answering 503
+MAX_PENDING = int(os.getenv("MESSENGER_MAX_PENDING", "2000"))
+VERIFY_TOKEN = os.getenv("MESSENGER_VERIFY_TOKEN", "")
+# Meta signs every webhook POST with it (X-Hub-Signature-256); unsigned or
+# wrongly signed payloads are refused, and all of them are when it is empty
+APP_SECRET = os.getenv("MESSENGER_APP_SECRET", "")
+SIGNATURE_HEADER = b"x-hub-signature-256"
+# Required in the DIAGNOSTICS_HEADER header by /debug/memory (the endpoint is
+# off when empty). Not a query parameter, which access logs would record.
+DIAGNOSTICS_TOKEN = os.getenv("AUTOFLUJO_DIAGNOSTICS_TOKEN", "")
+DIAGNOSTICS_HEADER = b"x-diagnostics-token"
+# Restaurant (onboarding email) this number/page belongs to, for usage accounting
+RESTAURANT = os.getenv("MESSENGER_RESTAURANT_EMAIL", "")
+
+# Rapid-fire messages of a thread ("hola", "quiero reservar", "para 4") are merged
+# into one graph run: the batch keeps growing while messages arrive less than
+# COALESCE_WINDOW seconds apart, for at most COALESCE_MAX_WAIT seconds.
+COALESCE_WINDOW = float(os.getenv("MESSENGER_COALESCE_WINDOW", "1.5"))
+COALESCE_MAX_WAIT = float(os.getenv("MESSENGER_COALESCE_MAX_WAIT", "5"))
+MAX_BATCH = int(os.getenv("MESSENGER_MAX_BATCH", "10"))
+
+FALLBACK_REPLY = (
+    "Lo siento, tuve un problema para responder. ¿Podrías repetir tu mensaje?"
+)
+
+
+# ----------------------------------------------------------
+# Payload parsing
+# ----------------------------------------------------------
+def parse_webhook_payload(payload):
+    """
+    Returns the text messages in a webhook payload as dicts with
+    "channel", "thread_id", "message_id" and "text".
+    Status updates, reactions and media without text are ignored.
+    """
+    incoming = []
+    for entry in payload.get("entry", []):
+        # WhatsApp Cloud API: entry[].changes[].value.messages[]
+        for change in entry.get("changes", []):
+            for message in change.get("value", {}).get("messages", []):
+                if message.get("type") == "text":
+                    incoming.append(
+                        {
+                            "channel": "whatsapp",
+                            "thread_id": message["from"],
+                            "message_id": message.get("id"),
+                            "text": message["text"]["body"],
+                        }
+                    )
+        # Messenger / Instagram: entry[].messaging[]
+        for event in entry.get("messaging", []):
+            message = event.get("message", {})
+            if message.get("text") and not message.get("is_echo"):
+                incoming.append(
+                    {
+                        "channel": "messenger",
+                        "thread_id": event["sender"]["id"],
+                        "message_id": message.get("mid"),
+                        "text": message["text"],
+                    }
+                )
+    return incoming
+
+
+# ----------------------------------------------------------
+# Outbound senders
+# ----------------------------------------------------------
+class OutboundSender(abc.ABC):
+    """Delivers a reply to the user. Subclasses implement send()."""
+
+    @abc.abstractmethod
+    async def send(self, channel, thread_id, text):
+        pass
+
+
+class StubSender(OutboundSender):
+    """Keeps replies in memory instead of calling any API (local testing)."""
+
+    def __init__(self, verbose=True):
+        self.sent = []
+        self.verbose = verbose
+
+    async def send(self, channel, thread_id, text):
+        self.sent.append((channel, thread_id, text))
+        if self.verbose:
+            print(f"[{channel}] -> {thread_id}: {text}")
+
+
+class GraphAPISender(OutboundSender):
+    """Sends replies through the Meta Graph API (WhatsApp Cloud API and Messenger)."""
+
+    def __init__(
+        self, access_token, whatsapp_phone_number_id=None, api_version="v21.0"
+    ):
+        self.access_token = access_token
+        self.whatsapp_phone_number_id = whatsapp_phone_number_id
+        self.base_url = f"https://graph.facebook.com/{api_version}"
+        self.session = get_session("meta")
+
+    async def send(self, channel, thread_id, text):
+        if channel == "whatsapp":
+            url = f"{self.base_url}/{self.whatsapp_phone_number_id}/messages"
+            body = {
+                "messaging_product": "whatsapp",
+                "to": thread_id,
+                "type": "text",
+                "text": {"body": text},
+            }
+        else:
+            url = f"{self.base_url}/me/messages"
+            body = {"recipient": {"id": thread_id}, "message": {"text": text}}
+
+        def post():
+            response = self.session.post(
+                url,
+                json=body,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                timeout=10,
+            )
+            response.raise_for_status()
+
+        await asyncio.get_running_loop().run_in_executor(None, post)
+
+
+def default_sender():
+    access_token = os.getenv("META_ACCESS_TOKEN")
+    if access_token:
+        return GraphAPISender(access_token, os.getenv("WHATSAPP_PHONE_NUMBER_ID"))
+    print("META_ACCESS_TOKEN is not set; replies go to StubSender.")
+    return StubSender()
+
+
+def default_process_turn(thread_id, texts, message_ids=()):
+    # Imported here so the server starts without building the graph
+    from langchain_core.messages import HumanMessage
+    from restaurant_graph import call_model_from_messenger
+
+    return call_model_from_messenger(
+        [HumanMessage(content=text) for text in texts],
+        {"configurable": {"thread_id": thread_id, "restaurant": RESTAURANT}},
+        # Redeliveries of the same messages get the stored reply
+        idempotency_key=message_ids_key(thread_id, list(message_ids)),
+    )
+
+
+# ----------------------------------------------------------
+# Dispatcher
+# ----------------------------------------------------------
+class TurnDispatcher:
+    """
+    Runs graph turns on a bounded pool with per-thread ordering and coalescing.
+
+    Every thread_id gets its own queue and a consumer task that exists only while
+    the queue has messages, so idle conversations cost nothing.
+    """
+
+    def __init__(
+        self,
+        process_turn=default_process_turn,
+        sender=None,
+        max_workers=MAX_WORKERS,
+        max_pending=MAX_PENDING,
+        coalesce_window=COALESCE_WINDOW,
+        coalesce_max_wait=COALESCE_MAX_WAIT,
+        max_batch=MAX_BATCH,
+    ):
+        self.process_turn = process_turn
+        self.sender = sender or default_sender()
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_wait = coalesce_max_wait
+        self.max_batch = max_batch
+
+        self._executor = None
+        self._slots = None
+        self._threads = {}  # thread_id -> asyncio.Queue
+        self._tasks = set()
+        self.pending = 0
+        self.stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "turns": 0,
+            "coalesced": 0,
+            "errors": 0,
+        }
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="graph-turn"
+        )
+        self._slots = asyncio.Semaphore(self.max_workers)
+
+    async def stop(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    def submit(self, message):
+        """Queues one incoming message. Returns False when the process is saturated."""
+        if self.pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            return False
+
+        self.pending += 1
+        self.stats["accepted"] += 1
+        thread_id = message["thread_id"]
+        inbox = self._threads.get(thread_id)
+        if inbox is None:
+            inbox = self._threads[thread_id] = asyncio.Queue()
+            task = asyncio.get_running_loop().create_task(
+                self._consume(thread_id, inbox)
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        inbox.put_nowait(message)
+        return True
+
+    def submit_all(self, messages):
+        """
+        Queues every message of a webhook delivery, or none of them when they
+        don't all fit (the platform redelivers the whole payload).
+        """
+        if self.pending + len(messages) > self.max_pending:
+            self.stats["rejected"] += len(messages)
+            return False
+        for message in messages:
+            self.submit(message)
+        return True
+
+    async def _consume(self, thread_id, inbox):
+        loop = asyncio.get_running_loop()
+        while not inbox.empty():
+            batch = await self._collect_batch(inbox)
+            texts = [message["text"] for message in batch]
+            message_ids = [message.get("message_id") for message in batch]
+            try:
+                async with self._slots:
+                    reply = await loop.run_in_executor(
+                        self._executor,
+                        self.process_turn,
+                        thread_id,
+                        texts,
+                        message_ids,
+                    )
+                self.stats["turns"] += 1
+                self.stats["coalesced"] += len(batch) - 1
+            except Exception as e:
+                print(f"Error processing turn for {thread_id}: {e}")
+                self.stats["errors"] += 1
+                reply = FALLBACK_REPLY
+            finally:
+                self.pending -= len(batch)
+
+            if reply:
+                try:
+                    await self.sender.send(batch[-1]["channel"], thread_id, reply)
+                except Exception as e:
+                    print(f"Error sending reply to {thread_id}: {e}")
+                    self.stats["errors"] += 1
+
+        # No await between the empty() check and this, so no message can slip in
+        del self._threads[thread_id]
+
+    async def _collect_batch(self, inbox):
+        """
+        Takes the queued messages of a thread as one batch. While new messages keep
+        arriving within coalesce_window seconds the batch keeps growing, up to
+        coalesce_max_wait seconds or max_batch messages.
+        """
+        batch = [inbox.get_nowait()]
+        if self.coalesce_window > 0:
+            deadline = asyncio.get_running_loop().time() + self.coalesce_max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                size_before = inbox.qsize()
+                await asyncio.sleep(min(self.coalesce_window, remaining))
+                if inbox.qsize() == size_before:
+                    break  # Burst is over
+                while not inbox.empty() and len(batch) < self.max_batch:
+                    batch.append(inbox.get_nowait())
+        # Messages that arrived while the previous turn was running
+        while not inbox.empty() and len(batch) < self.max_batch:
+            batch.append(inbox.get_nowait())
+        return batch
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "pending": self.pending,
+            "active_threads": len(self._threads),
+            "max_workers": self.max_workers,
+        }
+
+
+# ----------------------------------------------------------
+# ASGI app
+# ----------------------------------------------------------
+async def _read_body(receive):
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+
+def valid_signature(body, signature, app_secret):
+    """True when `signature` ("sha256=<hex>") is the HMAC-SHA256 of the raw body."""
+    if not app_secret or not signature.startswith(b"sha256="):
+        return False
+    expected = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature[len(b"sha256=") :], expected.encode())
+
+
+async def _respond(send, status, body, content_type=b"application/json", headers=()):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type), *headers],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_app(
+    dispatcher_factory=TurnDispatcher, verify_token=VERIFY_TOKEN, app_secret=APP_SECRET
+):
+    """Builds the ASGI app. The dispatcher is created on lifespan startup."""
+    state = {"dispatcher": None}
+
+    def get_dispatcher():
+        # Servers without lifespan support start it on the first request
+        if state["dispatcher"] is None:
+            state["dispatcher"] = dispatcher_factory()
+            state["dispatcher"].start()
+        return state["dispatcher"]
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                event = await receive()
+                if event["type"] == "lifespan.startup":
+                    prewarm_on_start()
+                    start_memory_profiler()
+                    get_dispatcher()
+                    await send({"type": "lifespan.startup.complete"})
+                elif event["type"] == "lifespan.shutdown":
+                    if state["dispatcher"] is not None:
+                        await state["dispatcher"].stop()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+
+        method, path = scope["method"], scope["path"].rstrip("/")
+
+        if path == "/webhook" and method == "GET":
+            # Meta verification handshake
+            query = parse_qs(scope.get("query_string", b"").decode())
+            mode = query.get("hub.mode", [""])[0]
+            token = query.get("hub.verify_token", [""])[0]
+            if mode == "subscribe" and verify_token and token == verify_token:
+                challenge = query.get("hub.challenge", [""])[0].encode()
+                await _respond(send, 200, challenge, content_type=b"text/plain")
+            else:
+                await _respond(send, 403, {"error": "verification failed"})
+            return
+
+        if path == "/webhook" and method == "POST":
+            body = await _read_body(receive)
+            signature = dict(scope.get("headers", [])).get(SIGNATURE_HEADER, b"")
+            if not valid_signature(body, signature, app_secret):
+                await _respond(send, 403, {"error": "invalid signature"})
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except json.JSONDecodeError:
+                await _respond(send, 400, {"error": "invalid JSON"})
+                return
+
+            dispatcher = get_dispatcher()
+            if dispatcher.submit_all(parse_webhook_payload(payload)):
+                await _respond(send, 200, {"status": "ok"})
+            else:
+                # Nothing was queued, so Meta's retry of the whole payload (it
+                # retries non-2xx deliveries) is the backpressure we want
+                await _respond(
+                    send, 503, {"error": "overloaded"}, headers=[(b"retry-after", b"5")]
+                )
+            return
+
+        if path == "/health" and method == "GET":
+            await _respond(
+                send,
+                200,
+                {
+                    **get_dispatcher().snapshot(),
+                    "dependencies": dependency_health(),
+                    "connections": pool_stats(),
+                },
+            )
+            return
+
+        if path == "/debug/memory" and method == "GET" and DIAGNOSTICS_TOKEN:
+            token = dict(scope.get("headers", [])).get(DIAGNOSTICS_HEADER, b"")
+            if not hmac.compare_digest(token, DIAGNOSTICS_TOKEN.encode()):
+                await _respond(send, 403, {"error": "forbidden"})
+                return
+            # Counting objects walks the whole heap; keep it off the event loop
+            report = await asyncio.get_running_loop().run_in_executor(
+                None, get_memory_profiler().report
+            )
+            await _respond(send, 200, json.dumps(report, default=str).encode())
+            return
+
+        await _respond(send, 404, {"error": "not found"})
+
+    app.get_dispatcher = get_dispatcher
+    return app
+
+
+app = create_app()
@@ -0,0 +1,173 @@
+# prompt_compiler.py
+# Builds the system prompt and tool set of call_model from the conversation state.
+#
+# react_prompt carries the first-interaction greeting, the slot collection rules
+# and the instructions for every reservation tool, and call_model used to send all
+# of it and bind every tool on every turn. Here the sections and tools that can't
+# apply are left out: no greeting after the first reply, no slot collection
+# rules once every slot is filled, no update/cancel tools while there's no
+# reservation ID. The add tool is always bound: after a cancellation, or for a
+# second reservation in the same conversation, the agent must still be able to
+# book.
+# Each combination is compiled once and the token savings are tallied per turn.
+import json
+import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from string import Formatter
+
+from langchain_core.messages import AIMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from agents import (
+    add_user_to_restaurant_db,
+    cancel_reservation_in_restaurant_db,
+    consultar_disponibilidad,
+    extract_tools,
+    get_llm,
+    react_prompt_sections,
+    single_call_section,
+    tools,
+    update_reservation_in_restaurant_db,
+)
+
+try:
+    import tiktoken
+except ImportError:  # Optional: token counts are estimated without it
+    tiktoken = None
+
+# Set to "0" to always send the full prompt and every tool (A/B comparisons)
+PROMPT_COMPILER_ENABLED = os.getenv("AUTOFLUJO_PROMPT_COMPILER", "1") != "0"
+
+REQUIRED_SLOTS = ("name", "phone", "email", "persons_number", "date", "time")
+
+CompiledPrompt = namedtuple(
+    "CompiledPrompt", ["template", "parts", "tools", "llm", "tokens", "full_tokens"]
+)
+
+_stats_lock = threading.Lock()
+_stats = {"turns": 0, "tokens_sent": 0, "tokens_saved": 0}
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:  # Encoding files are downloaded on first use
+        return None
+
+
+def count_tokens(text):
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def _tools_tokens(selected_tools):
+    return sum(
+        count_tokens(json.dumps(convert_to_openai_tool(tool), ensure_ascii=False))
+        for tool in selected_tools
+    )
+
+
+def prompt_variant(state, id):
+    """
+    The parts of the state that decide which sections apply:
+    (has reservation ID, all slots filled, first turn).
+    """
+    complete = all(state.get(key) not in (None, "") for key in REQUIRED_SLOTS)
+    first_turn = not state.get("summary") and not any(
+        isinstance(message, AIMessage) for message in state["messages"]
+    )
+    return bool(id), complete, first_turn
+
+
+@lru_cache(maxsize=None)
+def compile_prompt(has_id, complete, first_turn, single_call=False, model=None):
+    """Returns the CompiledPrompt of one state combination (memoized)."""
+    full_tools = tools + extract_tools if single_call else tools
+    full_template = "".join(react_prompt_sections.values())
+    if single_call:
+        full_template += single_call_section
+
+    skipped = set()
+    selected_tools = full_tools
+    if PROMPT_COMPILER_ENABLED:
+        if not first_turn:
+            skipped.add("greeting")
+        if complete:
+            skipped.add("collect")  # Nothing left to collect
+        if not has_id:
+            skipped |= {"reservation_params", "tool_update", "tool_cancel"}
+
+        selected_tools = [consultar_disponibilidad, add_user_to_restaurant_db]
+        if has_id:
+            selected_tools += [
+                update_reservation_in_restaurant_db,
+                cancel_reservation_in_restaurant_db,
+            ]
+        if single_call:
+            selected_tools += extract_tools
+
+    template = "".join(
+        text for name, text in react_prompt_sections.items() if name not in skipped
+    )
+    if single_call:
+        template += single_call_section
+
+    return CompiledPrompt(
+        template=template,
+        # (literal text, placeholder) pairs, parsed once for render()
+        parts=tuple(
+            (literal, field) for literal, field, _, _ in Formatter().parse(template)
+        ),
+        tools=tuple(selected_tools),
+        llm=(get_llm(model) if model else get_llm()).bind_tools(selected_tools),
+        tokens=count_tokens(template) + _tools_tokens(selected_tools),
+        full_tokens=count_tokens(full_template) + _tools_tokens(full_tools),
+    )
+
+
+def compile_for_state(state, id, single_call=False, model=None):
+    """
+    Compiled prompt for the current turn; also records its token savings.
+
+    Args:
+        state: Graph state (slots, messages, summary).
+        id: Reservation ID after this turn's tool results.
+        single_call: Add the slot-recording section and tool.
+        model: Model to bind instead of the default one.
+    """
+    compiled = compile_prompt(*prompt_variant(state, id), single_call, model)
+    saved = compiled.full_tokens - compiled.tokens
+    with _stats_lock:
+        _stats["turns"] += 1
+        _stats["tokens_sent"] += compiled.tokens
+        _stats["tokens_saved"] += saved
+    print(f"Prompt: {compiled.tokens} tokens ({saved} saved vs. full prompt)")
+    return compiled
+
+
+def render(compiled, **values):
+    """
+    Splices the values into the compiled template; same result as
+    compiled.template.format(**values) without parsing the template every turn.
+    The restaurant block comes precompiled from tenant_registry.
+    """
+    return "".join(
+        literal if field is None else literal + str(values[field])
+        for literal, field in compiled.parts
+    )
+
+
+def prompt_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["tokens_sent"] + stats["tokens_saved"]
+    stats["saved_ratio"] = stats["tokens_saved"] / total if total else 0.0
+    stats["variants_compiled"] = compile_prompt.cache_info().currsize
+    return stats
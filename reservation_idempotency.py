@@ -0,0 +1,49 @@
+# reservation_idempotency.py
+# Duplicate-call suppression for add_user_to_restaurant_db.
+#
+# The LLM sometimes books the same reservation twice (retries, or booked_status
+# not set yet). Each booking is keyed on (normalized phone, UTC date/time, party
+# size, thread). The first call claims the key before writing to Airtable; later
+# calls with the same key get the stored record back instead of a second write.
+import hashlib
+import re
+from functools import lru_cache
+
+from idempotency_store import IdempotencyStore
+
+IDEMPOTENCY_DB_PATH = "data/crm/reservation_idempotency.db"
+
+# How long a claim may stay "in progress" before another call may take it over
+CLAIM_TIMEOUT_SECONDS = 60
+# How long a duplicate call waits for an in-progress claim to finish
+WAIT_FOR_CLAIM_SECONDS = 15
+
+
+def normalize_phone(phone):
+    """'+52 (55) 5555-5555' and '5555555555' -> '5555555555' (last 10 digits)."""
+    digits = re.sub(r"\D", "", phone or "")
+    return digits[-10:]
+
+
+def reservation_key(telefono, fecha_y_hora, numero_personas, thread_id=""):
+    raw = "|".join(
+        [
+            normalize_phone(telefono),
+            fecha_y_hora or "",
+            str(int(numero_personas)) if numero_personas is not None else "",
+            str(thread_id or ""),
+        ]
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_idempotency_store():
+    """Process-wide store; claim() returns the stored Airtable record."""
+    return IdempotencyStore(
+        IDEMPOTENCY_DB_PATH,
+        "reservation_keys",
+        claim_timeout=CLAIM_TIMEOUT_SECONDS,
+        wait_seconds=WAIT_FOR_CLAIM_SECONDS,
+        busy_message="A reservation with the same details is in progress.",
+    )
@@ -0,0 +1,269 @@
+# reservations_bulk.py
+# Bulk import/export between CSV or JSONL files and the reservations table.
+#
+# Onboarding loads hundreds of existing bookings and reporting exports them, so
+# instead of one add_user_to_restaurant_db call per row:
+#   - local <-> UTC times are converted for the whole file at once with
+#     pyarrow.compute (timezone rules applied per array, not per record);
+#   - rows are written with Airtable's batch endpoint (10 records per request)
+#     at no more than REQUESTS_PER_SECOND;
+#   - every written batch is appended to a progress file (by booking key, so
+#     the file may be edited between runs), and an interrupted import resumes
+#     where it stopped. Rows matching a booking already in the table or an
+#     earlier row of the file (same phone, time and party size) are skipped.
+#
+# Run with:
+#   python reservations_bulk.py import reservas.csv
+#   python reservations_bulk.py export reservas.jsonl [--since 2025-01-01]
+import argparse
+import csv
+import json
+import os
+import time
+
+import pyarrow
+import pyarrow.compute
+
+from accounting import record_call
+from agents import DEFAULT_BASE_ID, DEFAULT_TABLE_NAME, _airtable_api
+from reservation_idempotency import reservation_key
+
+RESTAURANT_TIMEZONE = "America/Mexico_City"
+# Airtable: at most 10 records per write request and 5 requests/s per base
+BATCH_SIZE = 10
+REQUESTS_PER_SECOND = 4
+
+# File column -> Airtable field (same names as the reservation tools' arguments)
+FIELD_COLUMNS = {
+    "nombre": "Nombre",
+    "telefono": "Teléfono",
+    "email": "Email",
+    "numero_personas": "Nº Personas",
+    "notes": "Notes",
+    "estatus": "Estatus",
+}
+EXPORT_COLUMNS = ["record_id", "fecha", "hora", *FIELD_COLUMNS]
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / rate seconds apart."""
+
+    def __init__(self, rate=REQUESTS_PER_SECOND):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self._next:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+
+# ----------------------------------------------------------
+# Time conversion (whole columns at once)
+# ----------------------------------------------------------
+def local_to_utc(fechas, horas, timezone=RESTAURANT_TIMEZONE):
+    """
+    'YYYY-MM-DD' and 'HH:MM' local columns -> list of UTC ISO strings, None where
+    the date or time is missing or doesn't parse. Same rules as
+    agents.combine_date_and_time (ambiguous times resolve to standard time).
+    """
+    pc = pyarrow.compute
+    local = pc.binary_join_element_wise(
+        pyarrow.array(fechas, pyarrow.string()),
+        pyarrow.array(horas, pyarrow.string()),
+        " ",
+    )
+    naive = pc.strptime(local, format="%Y-%m-%d %H:%M", unit="s", error_is_null=True)
+    aware = pc.assume_timezone(
+        naive, timezone=timezone, ambiguous="latest", nonexistent="latest"
+    )
+    # strftime formats in the array's timezone, so switch it to UTC first
+    utc = aware.cast(pyarrow.timestamp("s", tz="UTC"))
+    return pc.strftime(utc, format="%Y-%m-%dT%H:%M:%S.000Z").to_pylist()
+
+
+def utc_to_local(values, timezone=RESTAURANT_TIMEZONE):
+    """UTC ISO strings from Airtable -> (fechas, horas) local columns."""
+    pc = pyarrow.compute
+    seconds = pc.utf8_slice_codeunits(pyarrow.array(values, pyarrow.string()), 0, 19)
+    utc = pc.strptime(seconds, format="%Y-%m-%dT%H:%M:%S", unit="s", error_is_null=True)
+    local = pc.assume_timezone(utc, timezone="UTC").cast(
+        pyarrow.timestamp("s", tz=timezone)
+    )
+    return (
+        pc.strftime(local, format="%Y-%m-%d").to_pylist(),
+        pc.strftime(local, format="%H:%M").to_pylist(),
+    )
+
+
+# ----------------------------------------------------------
+# Files
+# ----------------------------------------------------------
+def read_rows(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+
+def write_rows(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl"):
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def _load_progress(progress_path):
+    """Booking keys already written by an earlier run of the same import."""
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            for line in f:
+                done.update(json.loads(line).get("keys", []))
+    return done
+
+
+# ----------------------------------------------------------
+# Import / export
+# ----------------------------------------------------------
+def build_records(rows):
+    """Returns ([(row_number, fields)], [(row_number, error)])."""
+    utc_times = local_to_utc(
+        [str(row.get("fecha") or "").strip() for row in rows],
+        [str(row.get("hora") or "").strip() for row in rows],
+    )
+    records, errors = [], []
+    for number, (row, fecha_y_hora) in enumerate(zip(rows, utc_times)):
+        if not str(row.get("hora") or "").strip():
+            errors.append((number, "falta la hora"))
+            continue
+        if fecha_y_hora is None:
+            errors.append((number, "fecha/hora inválida"))
+            continue
+        try:
+            persons = int(str(row.get("numero_personas") or "").strip())
+        except ValueError:
+            errors.append((number, "numero_personas inválido o vacío"))
+            continue
+        if persons < 1:
+            errors.append((number, "numero_personas debe ser al menos 1"))
+            continue
+        fields = {
+            airtable: row[column]
+            for column, airtable in FIELD_COLUMNS.items()
+            if row.get(column) not in (None, "")
+        }
+        fields.update(
+            {
+                "Fecha y Hora": fecha_y_hora,
+                "Nº Personas": persons,
+                "Estatus": fields.get("Estatus", "Recibida"),
+            }
+        )
+        records.append((number, fields))
+    return records, errors
+
+
+def _booking_key(fields):
+    return reservation_key(
+        fields.get("Teléfono", ""),
+        fields["Fecha y Hora"][:16],
+        fields.get("Nº Personas"),
+    )
+
+
+def import_reservations(path, table, progress_path=None):
+    progress_path = progress_path or path + ".progress.jsonl"
+    records, errors = build_records(read_rows(path))
+    done = _load_progress(progress_path)
+
+    # Bookings already in the table (covers a batch written just before a crash)
+    existing = {
+        _booking_key(record["fields"])
+        for record in table.all(fields=["Teléfono", "Fecha y Hora", "Nº Personas"])
+        if record["fields"].get("Fecha y Hora")
+    }
+    pending, first_row = [], {}
+    for number, fields in records:
+        key = _booking_key(fields)
+        if key in first_row:
+            errors.append((number, f"duplicada de la fila {first_row[key] + 1}"))
+            continue
+        first_row[key] = number
+        if key not in done and key not in existing:
+            pending.append((key, fields))
+    errors.sort()
+    print(
+        f"{len(first_row)} valid rows, {len(first_row) - len(pending)} already "
+        f"imported, {len(errors)} invalid or duplicated."
+    )
+
+    limiter = RateLimiter()
+    with open(progress_path, "a", encoding="utf-8") as progress:
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = pending[start : start + BATCH_SIZE]
+            limiter.wait()
+            created = table.batch_create([fields for _, fields in batch])
+            record_call("airtable", "batch_create")
+            progress.write(
+                json.dumps(
+                    {
+                        "keys": [key for key, _ in batch],
+                        "ids": [record["id"] for record in created],
+                    }
+                )
+                + "\n"
+            )
+            progress.flush()
+            print(f"{start + len(batch)}/{len(pending)} written")
+
+    for number, error in errors:
+        print(f"Row {number + 1}: {error}")
+    return len(pending), errors
+
+
+def export_reservations(path, table, since=None):
+    formula = f"IS_AFTER({{Fecha y Hora}}, '{since}')" if since else None
+    records = table.all(formula=formula) if formula else table.all()
+    record_call("airtable", "all")
+    fechas, horas = utc_to_local(
+        [record["fields"].get("Fecha y Hora") for record in records]
+    )
+    rows = [
+        {
+            "record_id": record["id"],
+            "fecha": fecha or "",
+            "hora": hora or "",
+            **{
+                column: record["fields"].get(airtable, "")
+                for column, airtable in FIELD_COLUMNS.items()
+            },
+        }
+        for record, fecha, hora in zip(records, fechas, horas)
+    ]
+    write_rows(path, rows)
+    print(f"{len(rows)} reservations written to {path}")
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk import/export of the reservations table."
+    )
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", help="CSV or JSONL file")
+    parser.add_argument("--since", help="export: only reservations after this date")
+    parser.add_argument("--base", default=DEFAULT_BASE_ID)
+    parser.add_argument("--table", default=DEFAULT_TABLE_NAME)
+    args = parser.parse_args()
+
+    airtable = _airtable_api(os.getenv("AIRTABLE_API_KEY")).table(args.base, args.table)
+    if args.command == "import":
+        import_reservations(args.path, airtable)
+    else:
+        export_reservations(args.path, airtable, since=args.since)
@@ -12,19 +12,46 @@ from langchain_core.messages import (
 )
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import MessagesState
-import sqlite3
-from langgraph.checkpoint.sqlite import SqliteSaver
+import threading
+import weakref
+from functools import lru_cache
+from checkpoint_serde import CompactSerializer, PlainSerializer
+from checkpoint_store import (
+    CachedCheckpointSaver,
+    ShardedSqliteSaver,
+    shard_paths,
+)
 
 
 from datetime import datetime
 
+import chat_history
 from agents import (
-    react_prompt,
-    llm,
+    get_llm,
     tools,
     info_extraction_prompt,
     extract_tools,
     recordar_informacion_importante,
+    single_call_tools,
+)
+from prompt_compiler import compile_for_state, render
+from tenant_registry import get_tenant_registry
+from faq_answers import answer_question
+from tracing import traced_config
+from accounting import accounted_config, budget_model, over_budget
+from deadlines import (
+    CircuitOpenError,
+    DeadlineExceeded,
+    guarded_call,
+    has_time_for,
+    with_deadline,
+)
+from turn_idempotency import get_turn_store, turn_key
+
+# Sent when the LLM is too slow or unavailable, so the user still gets a reply
+DEGRADED_REPLY = (
+    "Lo siento, estoy tardando más de lo normal en responder. "
+    "¿Podrías repetir tu mensaje en un momento?"
 )
 
 
@@ -97,7 +124,10 @@ def call_model(state: State):
     current_datetime = datetime.now().strftime(
         "Hoy es %A, %d de %B de %Y a las %I:%M %p."
     )
-    content_prompt_with_time = react_prompt.format(
+    # Restaurants over their budget get the cheaper model (accounting.py)
+    compiled = compile_for_state(state, id, model=budget_model())
+    content_prompt_with_time = render(
+        compiled,
         restaurant_data=restaurant_data,
         name=name,
         phone=phone,
@@ -122,9 +152,12 @@ def call_model(state: State):
     else:
         messages = [SystemMessage(content=content_prompt_with_time)] + state["messages"]
 
-    # Bind tools to LLM and invoke
-    llm_with_tools = llm.bind_tools(tools)
-    response = llm_with_tools.invoke(messages)
+    # Invoke the LLM with the tools that apply to this state
+    try:
+        response = guarded_call("llm", compiled.llm.invoke, messages)
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        print(f"call_model degraded: {e}")
+        response = AIMessage(content=DEGRADED_REPLY)
 
     # Return the updated state values along with the LLM response
     return {
@@ -137,6 +170,16 @@ def call_model(state: State):
 def extract_data(state: State):
     print("NODE extract_data")
 
+    # Optional node: skipped for restaurants over their budget, or when the turn
+    # is short on time. It reads every message up to the last HumanMessage, so
+    # the next turn's extraction catches up on what was skipped.
+    if over_budget():
+        print("Budget exceeded. Skipping extract_data.")
+        return {}
+    if not has_time_for("extract_data"):
+        print("Turn budget short. Deferring extract_data.")
+        return {}
+
     # Retrieve existing known attributes from state
     name = state.get("name", "")
     phone = state.get("phone", "")
@@ -180,8 +223,12 @@ def extract_data(state: State):
         current_datetime=current_datetime,
     )
     messages = [SystemMessage(content=prompt)] + filtered_messages
-    llm_with_tools = llm.bind_tools(extract_tools)
-    ai_tool_message = llm_with_tools.invoke(messages)
+    llm_with_tools = get_llm().bind_tools(extract_tools)
+    try:
+        ai_tool_message = guarded_call("llm", llm_with_tools.invoke, messages)
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        print(f"extract_data deferred: {e}")
+        return {}
 
     # Check if the AIMessage requests a tool call
     if hasattr(ai_tool_message, "tool_calls") and ai_tool_message.tool_calls:
@@ -251,7 +298,16 @@ def summarize_conversation(state: State):
 
     # Add prompt to our history and invoke the LLM
     messages = state["messages"] + [HumanMessage(content=summary_message)]
-    response = llm.invoke(messages)
+    # Over budget: summarize with the cheaper model rather than skip it, since
+    # an unsummarized history makes every later prompt longer and costlier
+    model = budget_model()
+    llm = get_llm(model) if model else get_llm()
+    try:
+        response = guarded_call("llm", llm.invoke, messages)
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        # Messages stay as they are; the next turn summarizes them
+        print(f"summarize_conversation deferred: {e}")
+        return {}
 
     # Begin filtering logic
 
@@ -329,6 +385,127 @@ def summarize_conversation(state: State):
     return {"summary": response.content, "messages": delete_messages}
 
 
+# Maps the recordar_informacion_importante response keys to State keys
+SLOT_KEYS = ["name", "phone", "email", "persons_number", "date", "time", "requests"]
+
+
+def call_model_single(state: State):
+    """
+    Single-call variant of call_model + extract_data.
+
+    One LLM call with the reservation tools and recordar_informacion_importante
+    bound. The slot update is read straight from the recordar tool call, so the
+    separate extraction round-trip (and its duplicated prompt) is not needed.
+    """
+    print("NODE call_model_single")
+
+    restaurant_data = state.get("restaurant_data", "")
+    id = state.get("id", "")
+    booked_status = state.get("booked_status", False)
+    slots = {
+        "name": state.get("name", ""),
+        "phone": state.get("phone", ""),
+        "email": state.get("email", ""),
+        "persons_number": state.get("persons_number", None),
+        "date": state.get("date", ""),
+        "time": state.get("time", ""),
+        "requests": state.get("requests", ""),
+    }
+
+    # Check every ToolMessage of the last tool round (tools may run in parallel)
+    for message in reversed(state["messages"]):
+        if not isinstance(message, ToolMessage):
+            break
+        if message.name != "add_user_to_restaurant_db":
+            continue
+        try:
+            tool_response = json.loads(message.content)
+            if tool_response.get("success", False):
+                id = tool_response["record"]["id"]
+                booked_status = True
+                print(f"Reservation successful. ID: {id}")
+        except json.JSONDecodeError:
+            print("Error decoding tool message content. Skipping tool processing.")
+        except KeyError as e:
+            print(f"Missing key in tool response: {e}. Skipping tool processing.")
+
+    summary = state.get("summary", "")
+    current_datetime = datetime.now().strftime(
+        "Hoy es %A, %d de %B de %Y a las %I:%M %p."
+    )
+    compiled = compile_for_state(state, id, single_call=True, model=budget_model())
+    content_prompt_with_time = render(
+        compiled,
+        restaurant_data=restaurant_data,
+        current_datetime=current_datetime,
+        id=id,
+        booked_status=booked_status,
+        **slots,
+    )
+    if summary:
+        content_prompt_with_time += f"Resumen de la conversación anterior: {summary}"
+    messages = [SystemMessage(content=content_prompt_with_time)] + state["messages"]
+
+    try:
+        response = guarded_call("llm", compiled.llm.invoke, messages)
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        print(f"call_model_single degraded: {e}")
+        response = AIMessage(content=DEGRADED_REPLY)
+
+    # Apply every recordar_informacion_importante call to the slots
+    record_calls = [
+        tool_call
+        for tool_call in response.tool_calls
+        if tool_call.get("name") == "recordar_informacion_importante"
+    ]
+    for tool_call in record_calls:
+        tool_args = tool_call.get("args", {})
+        tool_response = recordar_informacion_importante(
+            nombre_del_cliente=tool_args.get("nombre_del_cliente"),
+            telefono=tool_args.get("telefono"),
+            correo_electronico=tool_args.get("correo_electronico"),
+            numero_de_personas=tool_args.get("numero_de_personas"),
+            fecha=tool_args.get("fecha"),
+            hora=tool_args.get("hora"),
+            solicitudes_extra=tool_args.get("solicitudes_extra"),
+        )
+        for key in SLOT_KEYS:
+            if tool_response.get(key) is not None:
+                slots[key] = tool_response[key]
+        print("Processed reservation data updated in state from single call.")
+
+    # If the model already wrote the reply and only asked to record slots, drop
+    # those calls so the turn ends here instead of going through the tools node.
+    other_calls = [
+        tool_call
+        for tool_call in response.tool_calls
+        if tool_call.get("name") != "recordar_informacion_importante"
+    ]
+    if record_calls and response.content and not other_calls:
+        response = AIMessage(
+            content=response.content,
+            id=response.id,
+            response_metadata=response.response_metadata,
+            usage_metadata=response.usage_metadata,
+        )
+
+    return {
+        "messages": response,
+        "id": id,
+        "booked_status": booked_status,
+        **slots,
+    }
+
+
+def route_single_call(state: State):
+    """Return the next node to execute after call_model_single."""
+    print("EDGE route_single_call")
+    last_message = state["messages"][-1]
+    if isinstance(last_message, AIMessage) and last_message.tool_calls:
+        return "tools"
+    return should_continue(state)
+
+
 def dummy_node(state: State):
     print("NODE dummy_node")
     pass
@@ -340,7 +517,9 @@ def should_continue(state: State):
     messages = state["messages"]
 
     # If there are more than six messages, then we summarize the conversation
-    if len(messages) > 18:
+    # (optional: skipped when the turn is short on time; the next turn
+    # summarizes instead)
+    if len(messages) > 18 and has_time_for("summarize_conversation"):
         return "summarize_conversation"
 
     # Otherwise we can just end
@@ -373,43 +552,288 @@ workflow.add_conditional_edges(
 workflow.add_edge("summarize_conversation", END)
 
 
+# Single-call workflow: dialogue and slot extraction in one LLM call per turn
+single_call_workflow = StateGraph(State)
+
+single_call_workflow.add_node("call_model", call_model_single)
+single_call_workflow.add_node("tools", ToolNode(single_call_tools))
+single_call_workflow.add_node("summarize_conversation", summarize_conversation)
+
+single_call_workflow.set_entry_point("call_model")
+single_call_workflow.add_conditional_edges(
+    "call_model",
+    route_single_call,
+    {
+        "tools": "tools",
+        "summarize_conversation": "summarize_conversation",
+        END: END,
+    },
+)
+single_call_workflow.add_edge("tools", "call_model")
+single_call_workflow.add_edge("summarize_conversation", END)
+
+
 # MEMORY
 
-# Ensure the 'data' directory exists
-os.makedirs("data", exist_ok=True)
+DB_PATH = "data/graphs/your_database_file.db"
 
-# Create an SQLite connection with check_same_thread=False
-conn = sqlite3.connect("data/graphs/your_database_file.db", check_same_thread=False)
+# "single" runs dialogue and extraction in one LLM call, "split" keeps two calls
+GRAPH_MODE = os.getenv("AUTOFLUJO_GRAPH_MODE", "split")
 
-memory = SqliteSaver(conn)
 
-react_graph = workflow.compile(checkpointer=memory)
+# Threads are spread over this many SQLite files (1 keeps the single DB_PATH file)
+CHECKPOINT_SHARDS = int(os.getenv("CHECKPOINT_SHARDS", "1"))
+# Hits are checked against the DB's latest checkpoint id, so the cache stays
+# correct when several processes write the same thread
+CHECKPOINT_CACHE_MB = int(os.getenv("CHECKPOINT_CACHE_MB", "64"))
+# "compact" (slim messages + compression) or "jsonplus" (LangGraph's format).
+# Both read each other's rows; see checkpoint_serde.py for migrating old DBs.
+CHECKPOINT_SERDE = os.getenv("CHECKPOINT_SERDE", "compact")
 
 
-def call_model(messages, phone, restaurant_data, config):
-    # Do not include "messages" in the initial state
-    events = react_graph.stream(
-        {"messages": messages, "phone": phone, "restaurant_data": restaurant_data},
+@lru_cache(maxsize=None)
+def get_checkpointer():
+    """
+    Creates the checkpointer on first use instead of at import time.
+    WAL-mode SQLite with one connection per shard, sharded by thread_id
+    when CHECKPOINT_SHARDS > 1 so several processes can write concurrently.
+    """
+    if CHECKPOINT_SHARDS > 1:
+        paths = shard_paths(os.path.dirname(DB_PATH), CHECKPOINT_SHARDS)
+    else:
+        paths = [DB_PATH]
+    serde = CompactSerializer() if CHECKPOINT_SERDE == "compact" else PlainSerializer()
+    saver = ShardedSqliteSaver(paths, serde=serde)
+    if CHECKPOINT_SHARDS > 1:
+        # First sharded start: bring the conversations of the single file along
+        copied = saver.import_unsharded(DB_PATH)
+        if copied:
+            print(f"Moved {copied} checkpoint rows from {DB_PATH} into the shards.")
+
+    # Latest checkpoint of hot threads kept in memory (0 disables the cache)
+    if CHECKPOINT_CACHE_MB > 0:
+        saver = CachedCheckpointSaver(saver, max_bytes=CHECKPOINT_CACHE_MB * 1024**2)
+    return saver
+
+
+def checkpoint_cache_stats():
+    """Hit rate and memory use of the checkpoint cache, or None when disabled."""
+    saver = get_checkpointer()
+    return saver.stats() if isinstance(saver, CachedCheckpointSaver) else None
+
+
+@lru_cache(maxsize=None)
+def get_react_graph(mode=None):
+    """Compiles the graph for the given mode ("split" or "single") once per process."""
+    mode = mode or GRAPH_MODE
+    if mode == "single":
+        return single_call_workflow.compile(checkpointer=get_checkpointer())
+    return workflow.compile(checkpointer=get_checkpointer())
+
+
+# TURN SERIALIZATION
+
+# One lock per thread_id so two turns of the same conversation never run at the
+# same time (they would race on checkpoint writes and answer stale context).
+_thread_locks = weakref.WeakValueDictionary()
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(thread_id):
+    with _thread_locks_guard:
+        lock = _thread_locks.get(thread_id)
+        if lock is None:
+            lock = _thread_locks[thread_id] = threading.Lock()
+        return lock
+
+
+# CHAT HISTORY
+
+
+def _message_role_and_text(message):
+    """Returns (role, content) for transcript messages, or None for tool traffic."""
+    if isinstance(message, dict):
+        role = message.get("role")
+        if role in ("user", "human"):
+            return "user", message.get("content", "")
+        if role in ("assistant", "ai"):
+            return "assistant", message.get("content", "")
+        return None
+    if isinstance(message, str):
+        return "user", message
+    if isinstance(message, HumanMessage):
+        return "user", message.content
+    if isinstance(message, AIMessage) and not message.tool_calls and message.content:
+        return "assistant", message.content
+    return None
+
+
+def _ensure_transcript(thread_id):
+    """Backfills the transcript of an existing thread from its checkpoint history."""
+    if chat_history.has_thread(thread_id):
+        return
+
+    config = {"configurable": {"thread_id": thread_id}}
+    snapshots = list(get_react_graph().get_state_history(config))
+
+    # Walk oldest -> newest so messages removed by summaries are still captured
+    seen_ids = set()
+    transcript = []
+    for snapshot in reversed(snapshots):
+        for message in snapshot.values.get("messages", []):
+            if message.id in seen_ids:
+                continue
+            seen_ids.add(message.id)
+            role_and_text = _message_role_and_text(message)
+            if role_and_text and role_and_text[1]:
+                transcript.append(role_and_text)
+
+    chat_history.backfill(thread_id, transcript)
+
+
+def _record_turn(config, messages, response):
+    thread_id = config["configurable"]["thread_id"]
+    if not isinstance(messages, list):
+        messages = [messages]
+    turn = [
+        role_and_text
+        for role_and_text in map(_message_role_and_text, messages)
+        if role_and_text
+    ]
+    if response:
+        turn.append(("assistant", response))
+    chat_history.record_messages(thread_id, turn)
+
+
+def get_history(thread_id, before=None, limit=20):
+    """
+    Returns a page of the user-facing transcript, oldest message first.
+
+    Includes messages already folded into the summary. Pass the "seq" of the first
+    message of a page as `before` to load the previous page.
+    """
+    _ensure_transcript(thread_id)
+    return chat_history.get_page(thread_id, before=before, limit=limit)
+
+
+def call_model(
+    messages,
+    phone,
+    restaurant_data,
+    config,
+    idempotency_key=None,
+    client_timestamp=None,
+):
+    """
+    Runs one turn. A repeat of the same turn (same `idempotency_key`, or same
+    thread, message and `client_timestamp`) returns the first turn's reply.
+    Without either, every call is a new turn.
+    """
+    graph_input = {
+        "messages": messages,
+        "phone": phone,
+        "restaurant_data": restaurant_data,
+    }
+    return _run_idempotent_turn(graph_input, config, idempotency_key, client_timestamp)
+
+
+def call_model_from_messenger(messages, config, idempotency_key=None):
+    """
+    Runs one turn for a messenger conversation. `messages` may hold several
+    HumanMessages when a burst of user messages was coalesced into one turn.
+    Pass the webhook message ids as `idempotency_key` so redeliveries are absorbed.
+    """
+    graph_input = {"messages": messages}
+    # Restaurant block of the tenant this number/page belongs to, when published
+    restaurant = config["configurable"].get("restaurant")
+    tenant = get_tenant_registry().get(restaurant) if restaurant else None
+    if tenant is not None:
+        graph_input["restaurant_data"] = tenant.fragment
+    return _run_idempotent_turn(graph_input, config, idempotency_key)
+
+
+def _run_idempotent_turn(graph_input, config, idempotency_key, client_timestamp=None):
+    thread_id = config["configurable"]["thread_id"]
+    key = idempotency_key
+    if not key and client_timestamp:
+        messages = graph_input["messages"]
+        if not isinstance(messages, list):
+            messages = [messages]
+        text = "\n".join(
+            role_and_text[1]
+            for role_and_text in map(_message_role_and_text, messages)
+            if role_and_text and role_and_text[0] == "user"
+        )
+        key = turn_key(thread_id, text, client_timestamp)
+    if not key:
+        # Nothing identifies the submission: the same text sent twice is two turns
+        with _thread_lock(thread_id):
+            return _answer_turn(graph_input, config)
+
+    store = get_turn_store()
+    earlier = store.claim(key, thread_id)
+    if earlier is not None:
+        print(f"Repeated turn for {thread_id}; returning the stored reply.")
+        return earlier["reply"]
+    try:
+        with _thread_lock(thread_id):
+            response = _answer_turn(graph_input, config)
+    except BaseException:
+        store.release(key)
+        raise
+    store.complete(key, {"reply": response})
+    return response
+
+
+def _answer_turn(graph_input, config):
+    response = _answer_faq_turn(graph_input, config)
+    if response is None:
+        response = _run_turn(graph_input, config)
+    return response
+
+
+def _answer_faq_turn(graph_input, config):
+    """
+    Answers a plain FAQ question (hours, payment, pets, ...) from the restaurant's
+    precomputed answers, without running the graph. Returns None otherwise.
+    """
+    restaurant = config["configurable"].get("restaurant")
+    tenant = get_tenant_registry().get(restaurant) if restaurant else None
+    if tenant is None:
+        return None
+    messages = graph_input["messages"]
+    if not isinstance(messages, list):
+        messages = [messages]
+    user_texts = [
+        role_and_text[1]
+        for role_and_text in map(_message_role_and_text, messages)
+        if role_and_text and role_and_text[0] == "user"
+    ]
+    if len(user_texts) != 1:
+        return None
+    answer = answer_question(user_texts[0], tenant.answers, tenant.profile)
+    if answer is None:
+        return None
+
+    _ensure_transcript(config["configurable"]["thread_id"])
+    # Keep the exchange in the conversation state so later turns see it.
+    # summarize_conversation's only edge goes to END, so no step is left pending.
+    get_react_graph().update_state(
         config,
-        stream_mode="values",
+        {**graph_input, "messages": [*messages, AIMessage(content=answer)]},
+        as_node="summarize_conversation",
     )
+    _record_turn(config, messages, answer)
+    return answer
 
-    response = None  # Initialize response
-    for event in events:
-        # Each event is a dictionary containing different stages of the graph execution
-        if "messages" in event and event["messages"]:
-            response = event["messages"][
-                -1
-            ].content  # Get the content of the last message
 
-    return response  # Return the final response content
+def _run_turn(graph_input, config):
+    _ensure_transcript(config["configurable"]["thread_id"])
 
-
-def call_model_from_messenger(messages, config):
     # Do not include "messages" in the initial state
-    events = react_graph.stream(
-        {"messages": messages},
-        config,
+    events = get_react_graph().stream(
+        graph_input,
+        accounted_config(traced_config(with_deadline(config))),
         stream_mode="values",
     )
 
@@ -421,4 +845,5 @@ def call_model_from_messenger(messages, config):
                 -1
             ].content  # Get the content of the last message
 
+    _record_turn(config, graph_input["messages"], response)
     return response  # Return the final response content
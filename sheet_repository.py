@@ -0,0 +1,172 @@
+# sheet_repository.py
+# Upsert-oriented access to the onboarding Google Sheet.
+#
+# Keeps an email -> row index built from a single get_all_values() call, so lookups
+# don't hit the API. Writes go through batch_update/append_rows and can be queued
+# and flushed together to stay within the Sheets per-minute quotas.
+import re
+import threading
+import time
+
+from accounting import record_call
+
+# Columns: email, info_general, preguntas_frecuentes, info_adicional, (vacío), has_completed_form
+ROW_WIDTH = 6
+LAST_COLUMN = "F"
+
+
+class OnboardingSheet:
+    def __init__(
+        self, worksheet, index_ttl=300.0, miss_refresh_interval=10.0, flush_delay=5.0
+    ):
+        """
+        Args:
+            worksheet: gspread Worksheet holding one row per restaurant email.
+            index_ttl: Seconds before the row index is reloaded from the sheet.
+            miss_refresh_interval: Minimum seconds between reloads caused by unknown emails.
+            flush_delay: Seconds deferred writes wait before being flushed automatically.
+        """
+        self.worksheet = worksheet
+        self.index_ttl = index_ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self.flush_delay = flush_delay
+
+        self._lock = threading.RLock()
+        self._rows = {}  # email -> [row_number or None if not appended yet, values]
+        self._loaded_at = 0.0
+        self._pending_updates = {}  # email -> values
+        self._pending_appends = {}  # email -> values (keeps insertion order)
+        self._flush_timer = None
+
+    # ------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------
+    def refresh(self):
+        """Reloads the email -> row index with one API call."""
+        values = self.worksheet.get_all_values()
+        record_call("sheets", "get_all_values")
+        with self._lock:
+            rows = {}
+            for row_number, row in enumerate(values, start=1):
+                if row and row[0].strip():
+                    rows.setdefault(row[0].strip(), [row_number, row])
+            # Writes not flushed yet win over what the sheet has
+            for email, row in self._pending_updates.items():
+                if email in rows:
+                    rows[email][1] = row
+            for email, row in self._pending_appends.items():
+                rows[email] = [None, row]
+            self._rows = rows
+            self._loaded_at = time.time()
+
+    def get(self, email):
+        """Returns the row values for the email (pending writes included), or None."""
+        with self._lock:
+            age = time.time() - self._loaded_at
+            if age > self.index_ttl or (
+                email not in self._rows and age > self.miss_refresh_interval
+            ):
+                self.refresh()
+            entry = self._rows.get(email)
+            return list(entry[1]) if entry else None
+
+    # ------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------
+    def upsert(self, email, values, defer=False):
+        """
+        Updates the row of the email, or appends it if it doesn't exist.
+        With defer=True the write is queued and flushed together with others.
+        """
+        values = list(values) + [""] * (ROW_WIDTH - len(values))
+        with self._lock:
+            if self.get(email) is None or self._rows[email][0] is None:
+                # New row, or a row whose append is still queued
+                self._pending_appends[email] = values
+                self._rows[email] = [None, values]
+            else:
+                self._pending_updates[email] = values
+                self._rows[email][1] = values
+
+            if defer:
+                self._schedule_flush()
+            else:
+                self.flush()
+
+    def insert_placeholder(self, email, defer=True):
+        """Adds an empty, not-completed row for a new email (no-op if it exists)."""
+        with self._lock:
+            if self.get(email) is None:
+                self.upsert(email, [email, "", "", "", "", "0"], defer=defer)
+
+    def flush(self):
+        """Writes every queued update in one batch_update and every new row in one append_rows."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            pending_updates = self._pending_updates
+            appends = list(self._pending_appends.items())
+            self._pending_updates = {}
+            self._pending_appends = {}
+
+            try:
+                if pending_updates:
+                    self.worksheet.batch_update(
+                        [
+                            {
+                                "range": f"A{self._rows[email][0]}:"
+                                f"{LAST_COLUMN}{self._rows[email][0]}",
+                                "values": [values],
+                            }
+                            for email, values in pending_updates.items()
+                        ]
+                    )
+                    record_call("sheets", "batch_update")
+                    pending_updates = {}
+                if appends:
+                    response = self.worksheet.append_rows(
+                        [values for _, values in appends]
+                    )
+                    record_call("sheets", "append_rows")
+            except Exception:
+                # Put back what wasn't written so the next flush retries it
+                for email, values in pending_updates.items():
+                    self._pending_updates.setdefault(email, values)
+                for email, values in appends:
+                    self._pending_appends.setdefault(email, values)
+                raise
+
+            if appends:
+                first_row = _first_row_of_range(
+                    response.get("updates", {}).get("updatedRange", "")
+                )
+                for offset, (email, values) in enumerate(appends):
+                    row_number = first_row + offset if first_row else None
+                    self._rows[email] = [row_number, values]
+                if not first_row:
+                    # Couldn't tell where the rows landed; reload on next read
+                    self._loaded_at = 0.0
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(
+                self.flush_delay, self._flush_in_background
+            )
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing onboarding sheet writes, retrying later: {e}")
+            with self._lock:
+                self._schedule_flush()
+
+
+def _first_row_of_range(updated_range):
+    """'Sheet1!A10:F12' -> 10"""
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
@@ -0,0 +1,217 @@
+# tenant_registry.py
+# Versioned restaurant profiles, keyed by onboarding email.
+#
+# The onboarding form stores the restaurant as markdown in sheet columns 1-3.
+# publish() parses that into a profile (hours, payment, delivery, pets, extra
+# info, ...) and renders the prompt fragment and the canonical FAQ answers
+# (faq_answers.py) once. Every change is a new version in a local SQLite table,
+# so edits can be audited. Readers get the latest version from an in-process
+# cache, and publishing replaces only that restaurant's entry. Other processes
+# pick up a new version after REFRESH_SECONDS.
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from faq_answers import build_answers
+
+TENANTS_DB_PATH = "data/crm/tenants.db"
+# How long a cached profile is trusted before checking for a newer version
+REFRESH_SECONDS = 60
+
+# "**Label:** value" lines written by the onboarding form -> profile keys
+PROFILE_LABELS = {
+    "Nombre": "name",
+    "Tipo de Cocina": "cuisine",
+    "Dirección": "address",
+    "Menú Digital": "menu_url",
+    "Horario": "hours",
+    "Contacto": "contact",
+    "Servicio para llevar o domicilio": "delivery",
+    "Métodos de Pago": "payment",
+    "Promociones/Paquetes": "promotions",
+    "Ingreso con Mascotas": "pets",
+}
+GENERAL_KEYS = ("name", "cuisine", "address", "menu_url", "hours", "contact")
+FAQ_KEYS = ("delivery", "payment", "promotions", "pets")
+LABEL_PATTERN = re.compile(r"^\s*\*\*(.+?):\*\*\s*(.*)$")
+# Stored by the form when the additional info field is left empty
+NO_EXTRA_INFO = "No se agregó información adicional."
+
+TenantProfile = namedtuple(
+    "TenantProfile", ["email", "version", "profile", "fragment", "answers"]
+)
+
+
+def parse_row(row):
+    """
+    Sheet row [email, info_general, preguntas_frecuentes, info_adicional, ...]
+    -> profile dict. Lines after a label continue its value (the form's
+    multi-line fields, e.g. one line of hours per day). Free text before any
+    label is kept under "general_text" / "faq_text".
+    """
+    row = list(row) + [""] * (4 - len(row))
+    profile = {}
+    for column, text_key in ((1, "general_text"), (2, "faq_text")):
+        leftovers = []
+        key = None
+        for line in (row[column] or "").splitlines():
+            match = LABEL_PATTERN.match(line)
+            if match and match.group(1) in PROFILE_LABELS:
+                key = PROFILE_LABELS[match.group(1)]
+                profile[key] = match.group(2).strip()
+            elif not line.strip():
+                continue
+            elif key is not None:
+                profile[key] = f"{profile[key]}\n{line.strip()}".strip()
+            else:
+                leftovers.append(line.strip())
+        if leftovers:
+            profile[text_key] = "\n".join(leftovers)
+    extra_info = (row[3] or "").strip()
+    profile["extra_info"] = "" if extra_info == NO_EXTRA_INFO else extra_info
+    return profile
+
+
+def render_fragment(profile):
+    """The restaurant block spliced into the agent prompt."""
+    labels = {key: label for label, key in PROFILE_LABELS.items()}
+
+    def block(keys, text_key):
+        lines = [f"{labels[key]}: {profile[key]}" for key in keys if profile.get(key)]
+        if profile.get(text_key):
+            lines.append(profile[text_key])
+        return "\n".join(lines)
+
+    return f"""--- RESTAURANT DATA ---
+Información Básica:
+{block(GENERAL_KEYS, "general_text")}
+
+Preguntas Frecuentes:
+{block(FAQ_KEYS, "faq_text")}
+
+Información Adicional:
+{profile.get("extra_info", "")}
+-------------------------
+"""
+
+
+class TenantRegistry:
+    def __init__(self, db_path=TENANTS_DB_PATH, refresh_seconds=REFRESH_SECONDS):
+        self.db_path = db_path
+        self.refresh_seconds = refresh_seconds
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS tenant_profiles (
+                email TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                profile TEXT NOT NULL,
+                fragment TEXT NOT NULL,
+                answers TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (email, version)
+            )""")
+        self._conn.commit()
+        # email -> (TenantProfile, checked_at)
+        self._cache = {}
+
+    def _latest(self, email):
+        row = self._conn.execute(
+            "SELECT version, content_hash, profile, fragment, answers "
+            "FROM tenant_profiles WHERE email = ? ORDER BY version DESC LIMIT 1",
+            (email,),
+        ).fetchone()
+        if row is None:
+            return None, None
+        version, content_hash, profile, fragment, answers = row
+        return (
+            TenantProfile(
+                email, version, json.loads(profile), fragment, json.loads(answers)
+            ),
+            content_hash,
+        )
+
+    def get(self, email):
+        """Latest TenantProfile of the restaurant, or None if never published."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(email)
+            if cached is not None and now - cached[1] < self.refresh_seconds:
+                return cached[0]
+            tenant, _ = self._latest(email)
+            if tenant is not None:
+                self._cache[email] = (tenant, now)
+            return tenant
+
+    def publish(self, email, row):
+        """
+        Stores the sheet row as the restaurant's new version (when it changed) and
+        replaces its cache entry. Returns the latest TenantProfile.
+        """
+        profile = parse_row(row)
+        content_hash = hashlib.sha256(
+            json.dumps(profile, sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
+        with self._lock:
+            # Write lock before reading the latest version, so two processes
+            # publishing at once get consecutive versions
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tenant, latest_hash = self._latest(email)
+                if tenant is None or latest_hash != content_hash:
+                    version = tenant.version + 1 if tenant else 1
+                    fragment = render_fragment(profile)
+                    answers = build_answers(profile)
+                    self._conn.execute(
+                        "INSERT INTO tenant_profiles (email, version, content_hash, "
+                        "profile, fragment, answers, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            email,
+                            version,
+                            content_hash,
+                            json.dumps(profile, ensure_ascii=False),
+                            fragment,
+                            json.dumps(answers, ensure_ascii=False),
+                            time.time(),
+                        ),
+                    )
+                    tenant = TenantProfile(email, version, profile, fragment, answers)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._cache[email] = (tenant, time.monotonic())
+            return tenant
+
+    def history(self, email):
+        """Every version of the restaurant, oldest first, as (version, created_at, profile)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT version, created_at, profile FROM tenant_profiles "
+                "WHERE email = ? ORDER BY version",
+                (email,),
+            ).fetchall()
+        return [
+            (version, created, json.loads(profile))
+            for version, created, profile in rows
+        ]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_tenant_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TenantRegistry()
+        return _registry
@@ -0,0 +1,386 @@
+# tracing.py
+# Sampled, buffered tracing of graph turns.
+#
+# LangChain's built-in LangSmith export sends every run of every turn over the
+# network while the turn is running. Here each turn gets its own TurnTracer that
+# only collects the run tree in memory. When the turn ends, the tree is kept if
+# the thread is sampled or anything in it failed, and then handed to a background
+# writer that appends it to a local JSONL file of its own process (Streamlit and
+# the messenger workers never write the same file). In "upload" mode a second
+# background thread ships those files to LangSmith, so an outage or no network
+# only delays the upload; an upload lock file lets one process at a time do it.
+# Files older than TRACE_RETENTION_DAYS are deleted (once uploaded, in "upload").
+#
+# AUTOFLUJO_TRACING:
+#   off     - no tracing
+#   local   - sampled traces to data/traces/ only (works offline)
+#   upload  - local + asynchronous upload to LangSmith (default with LANGCHAIN_API_KEY)
+#   direct  - LangChain's own synchronous LangSmith export (previous behavior)
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from langchain_core.tracers.base import BaseTracer
+
+try:
+    import fcntl
+except ImportError:  # Windows: no upload lock, run a single uploading process
+    fcntl = None
+
+TRACES_DIR = "data/traces"
+TRACING_MODE = os.getenv(
+    "AUTOFLUJO_TRACING", "upload" if os.getenv("LANGCHAIN_API_KEY") else "local"
+)
+# Share of threads traced; a sampled thread is traced on every turn
+TRACE_SAMPLE_RATE = float(os.getenv("AUTOFLUJO_TRACE_SAMPLE_RATE", "0.1"))
+# Comma-separated thread_ids traced regardless of the sample rate
+ALWAYS_TRACED_THREADS = {
+    thread_id.strip()
+    for thread_id in os.getenv("AUTOFLUJO_TRACE_THREADS", "").split(",")
+    if thread_id.strip()
+}
+LANGSMITH_PROJECT = os.getenv("LANGCHAIN_PROJECT", "Restaurante Bot Tests")
+
+FLUSH_INTERVAL = 2.0  # Seconds between writes of the buffered traces
+MAX_QUEUED_TRACES = 1000  # Beyond this, traces are dropped (counted in stats)
+UPLOAD_INTERVAL = 30.0
+UPLOAD_BATCH_SIZE = 100
+MAX_FIELD_CHARS = 20000  # Long inputs/outputs are truncated in the file
+TRACE_RETENTION_DAYS = int(os.getenv("AUTOFLUJO_TRACE_RETENTION_DAYS", "14"))
+OFFSETS_FILE = "upload_offsets.json"
+
+
+@lru_cache(maxsize=1)
+def configure_tracing():
+    """Sets the LangChain tracing variables for the selected mode (once)."""
+    if TRACING_MODE == "direct":
+        os.environ.setdefault("LANGCHAIN_TRACING_V2", "true")
+        os.environ.setdefault("LANGCHAIN_ENDPOINT", "https://api.smith.langchain.com")
+        os.environ.setdefault("LANGCHAIN_PROJECT", LANGSMITH_PROJECT)
+    else:
+        # Traces go through TurnTracer instead of LangChain's global exporter
+        os.environ["LANGCHAIN_TRACING_V2"] = "false"
+        os.environ.pop("LANGSMITH_TRACING", None)
+
+
+def is_sampled(thread_id, rate=None):
+    """Stable per-thread decision, so a conversation is traced whole or not at all."""
+    rate = TRACE_SAMPLE_RATE if rate is None else rate
+    if str(thread_id) in ALWAYS_TRACED_THREADS or rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    digest = hashlib.blake2b(str(thread_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64 < rate
+
+
+def _json_default(obj):
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def _truncate(value):
+    text = json.dumps(value, ensure_ascii=False, default=_json_default)
+    if len(text) <= MAX_FIELD_CHARS:
+        return json.loads(text)
+    return {"truncated": text[:MAX_FIELD_CHARS]}
+
+
+def _flatten(run, thread_id):
+    """Run tree -> list of plain dicts (parents first), as LangSmith ingests them."""
+    rows, stack = [], [run]
+    while stack:
+        current = stack.pop()
+        rows.append(
+            {
+                "id": str(current.id),
+                "trace_id": str(current.trace_id),
+                "dotted_order": current.dotted_order,
+                "parent_run_id": (
+                    str(current.parent_run_id) if current.parent_run_id else None
+                ),
+                "name": current.name,
+                "run_type": current.run_type,
+                "start_time": current.start_time.isoformat(),
+                "end_time": current.end_time.isoformat() if current.end_time else None,
+                "inputs": _truncate(current.inputs),
+                "outputs": _truncate(current.outputs),
+                "error": current.error,
+                "tags": current.tags,
+                "extra": {"metadata": {"thread_id": thread_id}},
+            }
+        )
+        stack.extend(reversed(current.child_runs))
+    return rows
+
+
+def _has_error(run):
+    return bool(run.error) or any(_has_error(child) for child in run.child_runs)
+
+
+def _is_trace_file(name):
+    # traces-YYYY-MM-DD-<pid>.jsonl
+    return name.startswith("traces-") and name.endswith(".jsonl")
+
+
+def _load_offsets(directory):
+    path = os.path.join(directory, OFFSETS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def prune_trace_files(directory=TRACES_DIR, retention_days=TRACE_RETENTION_DAYS):
+    """Deletes trace files older than retention_days (in upload mode, once uploaded)."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime(
+        "%Y-%m-%d"
+    )
+    offsets = _load_offsets(directory) if TRACING_MODE == "upload" else None
+    for name in os.listdir(directory):
+        if not _is_trace_file(name) or name[len("traces-") :][:10] >= cutoff:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if offsets is not None and offsets.get(name, 0) < os.path.getsize(path):
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Pruned by another process
+
+
+# ----------------------------------------------------------
+# Per-turn tracer
+# ----------------------------------------------------------
+class TurnTracer(BaseTracer):
+    """Collects the runs of one turn; keeps them if sampled or on error."""
+
+    def __init__(self, thread_id, sampled, sink):
+        super().__init__()
+        self.thread_id = thread_id
+        self.sampled = sampled
+        self.sink = sink
+
+    def _persist_run(self, run):
+        errored = _has_error(run)
+        if self.sampled or errored:
+            # Serialized by the sink's thread, not here on the request path
+            self.sink.submit((run, self.thread_id, self.sampled, errored))
+        else:
+            self.sink.skipped += 1
+
+
+# ----------------------------------------------------------
+# Buffered file sink
+# ----------------------------------------------------------
+class TraceSink:
+    """
+    Appends traces to data/traces/traces-YYYY-MM-DD-<pid>.jsonl from a background
+    thread. submit() never blocks: when the buffer is full the trace is dropped.
+    Old files are pruned when the day changes.
+    """
+
+    def __init__(self, directory=TRACES_DIR, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_TRACES)
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+        self._day = None
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, name="trace-sink", daemon=True).start()
+
+    def submit(self, trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Error writing traces: {e}")
+                self.dropped += len(batch)
+
+    def _write(self, batch):
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        if day != self._day:
+            self._day = day
+            try:
+                prune_trace_files(self.directory)
+            except Exception as e:
+                print(f"Error pruning trace files: {e}")
+        path = os.path.join(self.directory, f"traces-{day}-{os.getpid()}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            for run, thread_id, sampled, errored in batch:
+                trace = {
+                    "thread_id": thread_id,
+                    "sampled": sampled,
+                    "error": errored,
+                    "runs": _flatten(run, thread_id),
+                }
+                f.write(json.dumps(trace, ensure_ascii=False, default=_json_default))
+                f.write("\n")
+        self.written += len(batch)
+
+    def stats(self):
+        return {
+            "mode": TRACING_MODE,
+            "sample_rate": TRACE_SAMPLE_RATE,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+        }
+
+
+# ----------------------------------------------------------
+# Asynchronous upload
+# ----------------------------------------------------------
+class TraceUploader:
+    """
+    Ships the trace files of every process to LangSmith from a background
+    thread. Progress is a byte offset per file (upload_offsets.json), so a
+    restart resumes where it stopped and a failed upload is retried on the next
+    pass. Every process runs an uploader, but a pass only runs while holding the
+    upload lock file, so each run is ingested once.
+    """
+
+    def __init__(self, directory=TRACES_DIR, interval=UPLOAD_INTERVAL, start=True):
+        self.directory = directory
+        self.interval = interval
+        self.offsets_path = os.path.join(directory, OFFSETS_FILE)
+        self.lock_path = os.path.join(directory, "upload.lock")
+        self.uploaded = 0
+        self.failures = 0
+        if start:
+            threading.Thread(target=self._run, name="trace-upload", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.upload_pending()
+            except Exception as e:
+                # Offline or LangSmith down: keep the files, retry next pass
+                self.failures += 1
+                print(f"Trace upload failed, will retry: {e}")
+
+    def _save_offsets(self, offsets):
+        tmp_path = self.offsets_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(offsets, f)
+        os.replace(tmp_path, self.offsets_path)
+
+    def upload_pending(self):
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # Another process is uploading
+            self._upload_files()
+
+    def _upload_files(self):
+        from langsmith import Client
+
+        client = Client()
+        names = sorted(
+            name for name in os.listdir(self.directory) if _is_trace_file(name)
+        )
+        # Forget pruned files
+        offsets = {
+            name: offset
+            for name, offset in _load_offsets(self.directory).items()
+            if name in names
+        }
+        for name in names:
+            path = os.path.join(self.directory, name)
+            with open(path, "rb") as f:
+                f.seek(offsets.get(name, 0))
+                while True:
+                    runs = []
+                    for _ in range(UPLOAD_BATCH_SIZE):
+                        line = f.readline()
+                        # A line without newline is still being written
+                        if not line.endswith(b"\n"):
+                            f.seek(f.tell() - len(line))
+                            break
+                        runs.extend(json.loads(line)["runs"])
+                    if not runs:
+                        break
+                    for run in runs:
+                        run["session_name"] = LANGSMITH_PROJECT
+                        for key in ("start_time", "end_time"):
+                            if run[key]:
+                                run[key] = datetime.fromisoformat(run[key])
+                    client.batch_ingest_runs(create=runs)
+                    self.uploaded += len(runs)
+                    offsets[name] = f.tell()
+                    self._save_offsets(offsets)
+
+
+# ----------------------------------------------------------
+# Entry point for graph turns
+# ----------------------------------------------------------
+_lock = threading.Lock()
+_sink = None
+_uploader = None
+
+
+def get_sink():
+    global _sink, _uploader
+    with _lock:
+        if _sink is None:
+            _sink = TraceSink()
+            if TRACING_MODE == "upload":
+                _uploader = TraceUploader()
+        return _sink
+
+
+def traced_config(config):
+    """Returns the turn's config with a TurnTracer added to its callbacks."""
+    configure_tracing()
+    if TRACING_MODE not in ("local", "upload"):
+        return config
+    thread_id = str(config.get("configurable", {}).get("thread_id", ""))
+    tracer = TurnTracer(thread_id, is_sampled(thread_id), get_sink())
+    callbacks = list(config.get("callbacks") or [])
+    return {**config, "callbacks": callbacks + [tracer]}
+
+
+def tracing_stats():
+    stats = get_sink().stats() if TRACING_MODE in ("local", "upload") else {}
+    stats["mode"] = TRACING_MODE
+    if _uploader is not None:
+        stats["uploaded_runs"] = _uploader.uploaded
+        stats["upload_failures"] = _uploader.failures
+    return stats
+
+
+if __name__ == "__main__":
+    # Upload the local trace files now (e.g. after running offline)
+    uploader = TraceUploader(start=False)
+    uploader.upload_pending()
+    print(f"Uploaded {uploader.uploaded} runs to LangSmith project {LANGSMITH_PROJECT}")
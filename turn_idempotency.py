@@ -0,0 +1,63 @@
+# turn_idempotency.py
+# Duplicate-turn suppression for the graph entry points.
+#
+# Streamlit reruns, double submits and webhook redeliveries can send the same
+# user message twice. Each turn is keyed (explicit key such as a per-submission
+# id, webhook message ids, or a hash of thread + message + client timestamp).
+# Turns with none of these are never suppressed: the same text sent twice ("sí")
+# can be two different answers. The first call claims the key
+# and runs the graph; repeats wait for it if it is still running and get the
+# stored reply instead of a second LLM turn. Keys expire after their TTL and the
+# table is capped at MAX_ENTRIES.
+import hashlib
+import os
+from functools import lru_cache
+
+from idempotency_store import IdempotencyStore
+
+from deadlines import TURN_BUDGET_SECONDS
+
+TURN_KEYS_DB_PATH = "data/crm/turn_keys.db"
+
+# Meta redelivers webhooks for hours
+KEY_TTL_SECONDS = int(os.getenv("AUTOFLUJO_TURN_KEY_TTL", str(6 * 3600)))
+MAX_ENTRIES = 50_000
+# How long a repeat waits for the running turn before giving up
+WAIT_FOR_TURN_SECONDS = TURN_BUDGET_SECONDS + 5
+# A claim older than this belongs to a crashed call and may be taken over
+CLAIM_TIMEOUT_SECONDS = TURN_BUDGET_SECONDS * 3
+
+
+def turn_key(thread_id, text, client_timestamp):
+    """
+    Key of a turn without an explicit key.
+
+    Args:
+        thread_id: Conversation the message belongs to.
+        text: The user's message(s), joined.
+        client_timestamp: When the client sent it.
+    """
+    raw = "|".join([str(thread_id), text or "", str(client_timestamp)])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def message_ids_key(thread_id, message_ids):
+    """Key of a webhook turn from the platform's message ids (None if missing)."""
+    if not message_ids or not all(message_ids):
+        return None
+    raw = "|".join([str(thread_id), *sorted(message_ids)])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_turn_store():
+    """Process-wide store; claim() returns {"reply": ...} of the earlier turn."""
+    return IdempotencyStore(
+        TURN_KEYS_DB_PATH,
+        "turn_keys",
+        claim_timeout=CLAIM_TIMEOUT_SECONDS,
+        wait_seconds=WAIT_FOR_TURN_SECONDS,
+        busy_message="The same message is still being answered.",
+        ttl=KEY_TTL_SECONDS,
+        max_entries=MAX_ENTRIES,
+    )